@@ -1,8 +1,9 @@
 from django import forms
 from django.conf import settings
 from django.utils.translation import gettext_lazy as _
-from django.contrib import admin
+from django.contrib import admin, messages
 from django.contrib.auth.models import Group
+from django.db import transaction
 
 from django_messages.utils import get_user_model
 User = get_user_model()
@@ -12,7 +13,11 @@ if "pinax.notifications" in settings.INSTALLED_APPS and getattr(settings, 'DJANG
 else:
     notification = None
 
-from django_messages.models import Message
+from django_messages.broadcast import run_broadcast
+from django_messages.cache import bump_mailbox_versions
+from django_messages.models import (ArchivedMessage, Broadcast, BroadcastJob,
+    MailboxCounters, Message, counters_enabled, participant_ids)
+from django_messages.signals import messages_sent
 
 class MessageAdminForm(forms.ModelForm):
     """
@@ -71,42 +76,88 @@ class MessageAdmin(admin.ModelAdmin):
         for other possible recipients. Prevents duplication by excludin the
         original recipient from the list of optional recipients.
 
+        A new message sends ``messages_sent`` and a new reply marks its
+        parent message as replied.
+
         When changing an existing message and choosing optional recipients,
         the message is effectively resent to those users.
+
+        The messages for the optional recipients are created by a
+        ``BroadcastJob`` in chunks. If ``DJANGO_MESSAGES_BACKGROUND_BROADCAST``
+        is enabled the job is left to the ``send_broadcasts`` command instead
+        of being run within the request.
         """
         obj.save()
+        if not change:
+            if obj.parent_msg is not None:
+                Message.objects.mark_replied(obj.parent_msg, obj.sent_at)
+            messages_sent.send(sender=Message, messages=[obj], user=obj.sender)
 
         if notification:
             # Getting the appropriate notice labels for the sender and recipients.
             if obj.parent_msg is None:
                 sender_label = 'messages_sent'
-                recipients_label = 'messages_received'
             else:
                 sender_label = 'messages_replied'
-                recipients_label = 'messages_reply_received'
 
             # Notification for the sender.
             notification.send([obj.sender], sender_label, {'message': obj,})
 
-        if form.cleaned_data['group'] == 'all':
-            # send to all users
-            recipients = User.objects.exclude(pk=obj.recipient.pk)
+        group = form.cleaned_data['group']
+        if not group:
+            return
+        job = BroadcastJob.objects.create(
+            sender=obj.sender,
+            # no group means all users
+            group=None if group == 'all' else Group.objects.get(pk=group),
+            exclude_user=obj.recipient,
+            parent_msg=obj.parent_msg,
+            subject=obj.subject,
+            body=obj.body,
+        )
+        if getattr(settings, 'DJANGO_MESSAGES_BACKGROUND_BROADCAST', False):
+            messages.info(request, _('The message will be sent to the other recipients in the background.'))
         else:
-            # send to a group of users
-            recipients = []
-            group = form.cleaned_data['group']
-            if group:
-                group = Group.objects.get(pk=group)
-                recipients.extend(
-                    list(group.user_set.exclude(pk=obj.recipient.pk)))
-        # create messages for all found recipients
-        for user in recipients:
-            obj.pk = None
-            obj.recipient = user
-            obj.save()
-
-            if notification:
-                # Notification for the recipient.
-                notification.send([user], recipients_label, {'message' : obj,})
+            run_broadcast(job)
+
+    def delete_queryset(self, request, queryset):
+        user_ids = participant_ids(queryset)
+        with transaction.atomic():
+            if counters_enabled():
+                MailboxCounters.objects.discount(queryset)
+            super(MessageAdmin, self).delete_queryset(request, queryset)
+        bump_mailbox_versions(user_ids)
+
+class BroadcastJobAdmin(admin.ModelAdmin):
+    list_display = ('subject', 'sender', 'group', 'status', 'progress',
+                    'created_at', 'finished_at')
+    list_filter = ('status',)
+    readonly_fields = ('status', 'sent_count', 'total', 'finished_at')
+    raw_id_fields = ('sender', 'exclude_user', 'parent_msg')
+
+    def progress(self, obj):
+        if obj.total is None:
+            return '-'
+        return '%d / %d' % (obj.sent_count, obj.total)
+    progress.short_description = _('progress')
+
+class BroadcastAdmin(admin.ModelAdmin):
+    """
+    Broadcasts store their content once and show up in the inbox of every
+    addressed user, without creating a message per user.
+    """
+    list_display = ('subject', 'sender', 'group', 'sent_at')
+    list_filter = ('sent_at', 'group')
+    search_fields = ('subject', 'body')
+    raw_id_fields = ('sender',)
+
+class ArchivedMessageAdmin(admin.ModelAdmin):
+    list_display = ('subject', 'sender', 'recipient', 'sent_at', 'archived_at')
+    list_filter = ('sent_at',)
+    search_fields = ('subject', 'body')
+    raw_id_fields = ('sender', 'recipient')
 
 admin.site.register(Message, MessageAdmin)
+admin.site.register(BroadcastJob, BroadcastJobAdmin)
+admin.site.register(Broadcast, BroadcastAdmin)
+admin.site.register(ArchivedMessage, ArchivedMessageAdmin)
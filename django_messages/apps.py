@@ -1,6 +1,16 @@
 from django.apps import AppConfig
+from django.db.models.signals import m2m_changed, post_migrate
 from django.utils.translation import ugettext_lazy as _
 
 class DjangoMessagesConfig(AppConfig):
     name = 'django_messages'
     verbose_name = _('Messages')
+
+    def ready(self):
+        from django.contrib.auth import get_user_model
+        from django_messages.models import bump_group_members
+        from django_messages.search import restore_search_index
+        post_migrate.connect(restore_search_index, sender=self)
+        groups = getattr(get_user_model(), 'groups', None)
+        if groups is not None:
+            m2m_changed.connect(bump_group_members, sender=groups.through)
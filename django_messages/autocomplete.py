@@ -0,0 +1,88 @@
+"""
+Username completion for the recipient field of the compose form.
+
+Usernames are matched case insensitively with an ``istartswith`` lookup.
+MySQL answers it from the index of the username column; on PostgreSQL create
+an index on ``UPPER(username::text) text_pattern_ops`` of the user table for
+the same effect.
+
+If ``DJANGO_MESSAGES_CACHE`` is set, results are cached for
+``DJANGO_MESSAGES_AUTOCOMPLETE_TIMEOUT`` seconds (default ``60``). A cached
+result with fewer than ``limit`` usernames holds all matches of its prefix,
+so longer prefixes are filtered from it without a query.
+"""
+import hashlib
+
+from django.conf import settings
+from django.utils.encoding import force_bytes
+
+from django_messages.cache import get_cache
+from django_messages.fields import RecipientFilter
+from django_messages.utils import get_user_model, get_username_field
+
+User = get_user_model()
+
+DEFAULT_LIMIT = 10
+DEFAULT_TIMEOUT = 60
+CACHE_KEY = 'django_messages:autocomplete:%s'
+
+
+def get_limit():
+    return getattr(settings, 'DJANGO_MESSAGES_AUTOCOMPLETE_LIMIT',
+                   DEFAULT_LIMIT)
+
+
+def _cache_key(scope, prefix):
+    digest = hashlib.md5(force_bytes('%s\n%s' % (scope, prefix))).hexdigest()
+    return CACHE_KEY % digest
+
+
+def _lookup(prefix, recipient_filter, limit):
+    username_field = get_username_field()
+    users = User.objects.filter(**{
+        '%s__istartswith' % username_field: prefix,
+    }).order_by(username_field)
+    if isinstance(recipient_filter, RecipientFilter):
+        users = recipient_filter.filter(users)
+    elif recipient_filter is not None:
+        # a per-user filter has to be applied to the fetched users
+        allowed = []
+        for user in users.iterator():
+            if recipient_filter(user) is not False:
+                allowed.append(getattr(user, username_field))
+                if len(allowed) == limit:
+                    break
+        return allowed
+    return list(users.values_list(username_field, flat=True)[:limit])
+
+
+def complete_usernames(prefix, recipient_filter=None, limit=None, scope=''):
+    """
+    Returns up to ``limit`` usernames starting with ``prefix`` which pass
+    the ``recipient_filter``. ``scope`` distinguishes the cached results of
+    different filters, e.g. the path of the view.
+    """
+    if limit is None:
+        limit = get_limit()
+    if not prefix:
+        return []
+    cache = get_cache()
+    if cache is None:
+        return _lookup(prefix, recipient_filter, limit)
+
+    prefix = prefix.lower()
+    key = _cache_key(scope, prefix)
+    cached = cache.get_many([
+        _cache_key(scope, prefix[:i]) for i in range(1, len(prefix) + 1)])
+    if key in cached:
+        return cached[key][:limit]
+    for names in cached.values():
+        if len(names) < limit:
+            # all matches of a shorter prefix are known
+            return [name for name in names
+                    if name.lower().startswith(prefix)]
+    names = _lookup(prefix, recipient_filter, limit)
+    timeout = getattr(settings, 'DJANGO_MESSAGES_AUTOCOMPLETE_TIMEOUT',
+                      DEFAULT_TIMEOUT)
+    cache.set(key, names, timeout)
+    return names
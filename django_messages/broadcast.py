@@ -0,0 +1,114 @@
+"""
+Chunked sending of messages to groups and all users.
+
+``run_broadcast`` can be called from any worker process, for example from the
+``send_broadcasts`` management command or a task queue consumer.
+"""
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from django_messages.instrumentation import instrumented
+from django_messages.models import BroadcastJob, Message
+from django_messages.utils import get_user_model
+
+if "pinax.notifications" in settings.INSTALLED_APPS and getattr(settings, 'DJANGO_MESSAGES_NOTIFY', True):
+    from pinax.notifications import models as notification
+else:
+    notification = None
+
+DEFAULT_CHUNK_SIZE = 1000
+
+# SQLite before 3.32 allows only 999 variables per statement, and the users
+# of a chunk are passed as a list to some queries
+SQLITE_MAX_CHUNK_SIZE = 900
+
+
+def get_chunk_size():
+    chunk_size = getattr(settings, 'DJANGO_MESSAGES_BROADCAST_CHUNK_SIZE',
+                         DEFAULT_CHUNK_SIZE)
+    if connection.vendor == 'sqlite':
+        chunk_size = min(chunk_size, SQLITE_MAX_CHUNK_SIZE)
+    return chunk_size
+
+
+def broadcast_recipients(job):
+    """
+    Returns all recipients of the given job ordered by primary key.
+    """
+    if job.group_id is None:
+        users = get_user_model().objects.all()
+    else:
+        users = job.group.user_set.all()
+    if job.exclude_user_id is not None:
+        users = users.exclude(pk=job.exclude_user_id)
+    return users.order_by('pk')
+
+
+def _send_chunk(job, chunk_size):
+    """
+    Sends the message to the next chunk of recipients and records the
+    progress in the same transaction. Returns the created messages, an
+    empty list once all recipients got the message.
+    """
+    with transaction.atomic():
+        # the lock keeps concurrent workers from sending the same chunk
+        job = BroadcastJob.objects.select_for_update().get(pk=job.pk)
+        users = broadcast_recipients(job)
+        if job.last_user_pk:
+            pk_field = users.model._meta.pk
+            users = users.filter(pk__gt=pk_field.to_python(job.last_user_pk))
+        users = list(users[:chunk_size])
+        if not users:
+            return []
+        messages = Message.objects.send(
+            job.sender, users, job.subject, job.body,
+            parent_msg=job.parent_msg)
+        BroadcastJob.objects.filter(pk=job.pk).update(
+            last_user_pk=str(users[-1].pk),
+            sent_count=job.sent_count + len(messages),
+        )
+    return messages
+
+
+@instrumented('broadcast.run')
+def run_broadcast(job, chunk_size=None):
+    """
+    Sends the message of ``job`` to all its recipients which didn't get it
+    yet, ``chunk_size`` users at a time.
+    """
+    if chunk_size is None:
+        chunk_size = get_chunk_size()
+    if job.status == BroadcastJob.DONE:
+        return
+    BroadcastJob.objects.filter(pk=job.pk).update(
+        status=BroadcastJob.RUNNING,
+        total=broadcast_recipients(job).count(),
+    )
+    if job.parent_msg_id is None:
+        recipients_label = 'messages_received'
+    else:
+        recipients_label = 'messages_reply_received'
+    while True:
+        messages = _send_chunk(job, chunk_size)
+        if not messages:
+            break
+        if notification:
+            for message in messages:
+                # Notification for the recipient.
+                notification.send([message.recipient], recipients_label, {'message': message,})
+    BroadcastJob.objects.filter(pk=job.pk).update(
+        status=BroadcastJob.DONE, finished_at=timezone.now())
+
+
+def run_pending_broadcasts(chunk_size=None):
+    """
+    Runs all jobs which are not done yet, including jobs which were
+    interrupted. Returns the number of processed jobs.
+    """
+    jobs = BroadcastJob.objects.exclude(status=BroadcastJob.DONE)
+    count = 0
+    for job in jobs:
+        run_broadcast(job, chunk_size)
+        count += 1
+    return count
@@ -0,0 +1,128 @@
+"""
+Optional caching of per-user mailbox data.
+
+Every cached value is stored under a key which contains the current version
+of the user's mailbox. Whenever a message of the user changes the version is
+bumped, which invalidates all cached values of that user at once.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from django_messages.changes import publish_change
+
+VERSION_KEY = 'django_messages:version:%s'
+MODIFIED_KEY = 'django_messages:modified:%s'
+VALUE_KEY = 'django_messages:%s:%s:%s.%s'
+
+# pseudo user id of the version shared by all users, bumped on broadcasts
+SHARED = 'shared'
+
+
+def get_cache():
+    """
+    Returns the cache configured with ``DJANGO_MESSAGES_CACHE`` or ``None``
+    if caching is disabled. The cache has to be shared by all processes.
+    """
+    alias = getattr(settings, 'DJANGO_MESSAGES_CACHE', None)
+    if not alias:
+        return None
+    return caches[alias]
+
+
+def _initial_version():
+    # Never restart at a version which might still have cached values, if
+    # the version key itself got evicted.
+    return int(time.time() * 1000)
+
+
+def get_mailbox_version(user_id, cache=None):
+    """
+    Returns the current mailbox version of the given user.
+    """
+    cache = cache or get_cache()
+    key = VERSION_KEY % user_id
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _initial_version(), None)
+        version = cache.get(key)
+    return version
+
+
+def _bump(user_ids, cache):
+    now = time.time()
+    for user_id in user_ids:
+        key = VERSION_KEY % user_id
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, _initial_version(), None)
+    cache.set_many(dict(
+        (MODIFIED_KEY % user_id, now) for user_id in user_ids), None)
+
+
+def bump_mailbox_versions(user_ids):
+    """
+    Invalidates the cached values of the given users and publishes the
+    change (see ``django_messages.changes``). Inside a transaction the
+    versions are bumped again after commit, so values calculated from the
+    not yet committed state don't survive.
+    """
+    cache = get_cache()
+    user_ids = [user_id for user_id in set(user_ids) if user_id is not None]
+    if not user_ids:
+        return
+    publish_change(user_ids, {'type': 'changed'})
+    if cache is None:
+        return
+    _bump(user_ids, cache)
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(lambda: _bump(user_ids, cache))
+
+
+def cached_for(user_id, name, default):
+    """
+    Returns the cached value ``name`` of the given user. If the value is
+    missing, ``default`` is called and its result is cached. Without a
+    configured cache ``default`` is simply called.
+    """
+    cache = get_cache()
+    if cache is None:
+        return default()
+    key = VALUE_KEY % (name, user_id, get_mailbox_version(user_id, cache),
+                       get_mailbox_version(SHARED, cache))
+    timeout = getattr(settings, 'DJANGO_MESSAGES_CACHE_TIMEOUT', 300)
+    return cache.get_or_set(key, default, timeout)
+
+
+def get_mailbox_etag(user_id):
+    """
+    Returns a value which changes whenever the mailbox of the given user or
+    a broadcast changes, or ``None`` if caching is disabled.
+    """
+    cache = get_cache()
+    if cache is None:
+        return None
+    return '%s.%s' % (get_mailbox_version(user_id, cache),
+                      get_mailbox_version(SHARED, cache))
+
+
+def get_mailbox_modified(user_id):
+    """
+    Returns the time of the last change of the mailbox of the given user or
+    of a broadcast as a timestamp, or ``None`` if caching is disabled.
+    """
+    cache = get_cache()
+    if cache is None:
+        return None
+    keys = [MODIFIED_KEY % user_id, MODIFIED_KEY % SHARED]
+    modified = cache.get_many(keys)
+    for key in keys:
+        if key not in modified:
+            # the time of earlier changes is unknown, so assume they just
+            # happened
+            cache.add(key, time.time(), None)
+            modified[key] = cache.get(key)
+    return max(modified.values())
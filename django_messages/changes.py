@@ -0,0 +1,103 @@
+"""
+Notifications about changed mailboxes, for pushing updates to clients.
+
+Whenever the mailbox of a user changes (see ``bump_mailbox_versions``) a
+change is published to the backend configured with
+``DJANGO_MESSAGES_CHANGE_BACKEND``. The default ``LocalChangeBackend`` keeps
+the changes in memory and only reaches clients connected to the same
+process. Deployments with several processes need a backend based on a
+broker shared by them, with the same methods.
+"""
+import collections
+import threading
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+from django_messages.utils import get_username_field
+
+DEFAULT_BACKEND = 'django_messages.changes.LocalChangeBackend'
+
+_backend = None
+
+
+class LocalChangeBackend(object):
+    """
+    Keeps the latest changes in memory. Each change gets the next number of
+    a sequence, which clients pass back to receive only newer changes.
+    """
+    def __init__(self, size=1000):
+        self.changes = collections.deque(maxlen=size)
+        self.sequence = 0
+        self.condition = threading.Condition()
+
+    def current(self):
+        """
+        Returns the number of the latest change.
+        """
+        return self.sequence
+
+    def publish(self, user_ids, event):
+        """
+        Publishes ``event`` (a dict) to the given users. ``SHARED`` as user id
+        addresses all users.
+        """
+        with self.condition:
+            for user_id in user_ids:
+                self.sequence += 1
+                self.changes.append((self.sequence, user_id, event))
+            self.condition.notify_all()
+
+    def _events_for(self, user_id, after):
+        # imported here, the cache module publishes through this module
+        from django_messages.cache import SHARED
+        return [event for sequence, change_user_id, event in self.changes
+                if sequence > after and change_user_id in (user_id, SHARED)]
+
+    def wait(self, user_id, after, timeout):
+        """
+        Waits up to ``timeout`` seconds for changes of the given user newer
+        than ``after``. Returns the number of the latest change and the
+        events of the user, which are empty after a timeout.
+        """
+        with self.condition:
+            events = self._events_for(user_id, after)
+            if not events:
+                self.condition.wait_for(
+                    lambda: self._events_for(user_id, after), timeout)
+                events = self._events_for(user_id, after)
+            return self.sequence, events
+
+
+def get_change_backend():
+    global _backend
+    path = getattr(settings, 'DJANGO_MESSAGES_CHANGE_BACKEND', DEFAULT_BACKEND)
+    if _backend is None or _backend[0] != path:
+        _backend = (path, import_string(path)())
+    return _backend[1]
+
+
+def publish_change(user_ids, event):
+    """
+    Publishes ``event`` to the given users once the current transaction is
+    committed, so listeners don't see uncommitted state.
+    """
+    user_ids = [user_id for user_id in set(user_ids) if user_id is not None]
+    if user_ids:
+        transaction.on_commit(
+            lambda: get_change_backend().publish(user_ids, event))
+
+
+def publish_new_message(sender, instance, signal, *args, **kwargs):
+    """
+    Tells the recipient of a new message about it. Connected to
+    ``post_save`` of ``Message``.
+    """
+    if kwargs.get('created') and not kwargs.get('raw'):
+        publish_change([instance.recipient_id], {
+            'type': 'message',
+            'id': instance.pk,
+            'subject': instance.subject,
+            'sender': getattr(instance.sender, get_username_field()),
+        })
@@ -1,15 +1,21 @@
+from django.utils.functional import lazy
+
 from django_messages.models import inbox_count_for
+from django_messages.utils import user_is_authenticated
 
-def _user_is_authenticated(user):
-    # django < 2.0
-    try:
-        return user.is_authenticated()
-    except TypeError:
-        # django >= 2.0
-        return user.is_authenticated
+def request_inbox_count(request):
+    """
+    Returns the number of unread messages of ``request.user``. The value is
+    memoized on the request, so it is queried at most once per request.
+    """
+    if not hasattr(request, '_messages_inbox_count'):
+        request._messages_inbox_count = inbox_count_for(request.user)
+    return request._messages_inbox_count
 
 def inbox(request):
-    if _user_is_authenticated(request.user):
-        return {'messages_inbox_count': inbox_count_for(request.user)}
+    if user_is_authenticated(request.user):
+        # only query the count if a template actually uses it
+        return {'messages_inbox_count': lazy(
+            lambda: request_inbox_count(request), int)()}
     else:
         return {}
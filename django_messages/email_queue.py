@@ -0,0 +1,124 @@
+"""
+Queued email notifications.
+
+If ``DJANGO_MESSAGES_EMAIL_QUEUE`` is enabled, saving a new message only
+stores a ``QueuedEmail`` row. The ``send_queued_emails`` command sends the
+emails in batches over one mail connection and retries failed rows with an
+exponential backoff.
+"""
+import datetime
+import smtplib
+import socket
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import connection, transaction
+from django.utils import timezone
+
+from django_messages.instrumentation import instrumented
+from django_messages.models import QueuedEmail
+from django_messages.utils import get_site_url, render_message_email
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_RETRY_DELAY = 60
+
+# errors after which the mail connection has to be opened again
+CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError,
+                     ConnectionError, socket.timeout)
+
+
+def queue_message_email(sender, instance, signal, *args, **kwargs):
+    """
+    Queues the notification email about a new message. Connected to
+    ``post_save`` of ``Message`` in place of ``new_message_email``.
+    ``Message.objects.send`` queues the emails of its messages itself, with
+    one insert.
+    """
+    if (kwargs.get('created') and not kwargs.get('raw') and
+            not getattr(instance, '_email_queued', False)):
+        QueuedEmail.objects.create(message=instance)
+
+
+def _retry_delay(attempts):
+    base = getattr(settings, 'DJANGO_MESSAGES_EMAIL_RETRY_DELAY',
+                   DEFAULT_RETRY_DELAY)
+    return datetime.timedelta(seconds=base * 2 ** (attempts - 1))
+
+
+def _due_batch(batch_size):
+    queue = QueuedEmail.objects.filter(
+        failed_at__isnull=True,
+        next_attempt_at__lte=timezone.now(),
+    ).select_related('message__sender', 'message__recipient')
+    if connection.features.has_select_for_update_skip_locked:
+        # lets several workers drain the queue side by side
+        queue = queue.select_for_update(skip_locked=True)
+    return list(queue.order_by('next_attempt_at', 'id')[:batch_size])
+
+
+def _send_batch(batch, mail_connection, site_url):
+    """
+    Sends the emails of ``batch`` over the open ``mail_connection``. Sent
+    rows are deleted, failed rows are rescheduled. A lost connection is
+    opened again for the remaining rows. Returns the number of sent emails.
+    """
+    max_attempts = getattr(settings, 'DJANGO_MESSAGES_EMAIL_MAX_ATTEMPTS',
+                           DEFAULT_MAX_ATTEMPTS)
+    sent = []
+    for queued in batch:
+        message = queued.message
+        if message.recipient is None or not message.recipient.email:
+            sent.append(queued.pk)
+            continue
+        try:
+            subject, body = render_message_email(message, site_url)
+            mail_connection.send_messages([EmailMessage(
+                subject, body, settings.DEFAULT_FROM_EMAIL,
+                [message.recipient.email])])
+        except Exception as e:
+            queued.attempts += 1
+            queued.last_error = '%s' % e
+            if queued.attempts >= max_attempts:
+                queued.failed_at = timezone.now()
+            else:
+                queued.next_attempt_at = (
+                    timezone.now() + _retry_delay(queued.attempts))
+            queued.save(update_fields=[
+                'attempts', 'last_error', 'failed_at', 'next_attempt_at'])
+            if isinstance(e, CONNECTION_ERRORS):
+                mail_connection.close()
+                try:
+                    mail_connection.open()
+                except CONNECTION_ERRORS:
+                    # the next send tries again
+                    pass
+        else:
+            sent.append(queued.pk)
+    QueuedEmail.objects.filter(pk__in=sent).delete()
+    return len(sent)
+
+
+@instrumented('email.send_queued', rows=int)
+def send_queued_emails(batch_size=None):
+    """
+    Sends all due queued emails, ``batch_size`` rows per transaction, over a
+    single mail connection. Returns the number of sent emails.
+    """
+    if batch_size is None:
+        batch_size = getattr(settings, 'DJANGO_MESSAGES_EMAIL_BATCH_SIZE',
+                             DEFAULT_BATCH_SIZE)
+    site_url = get_site_url()
+    mail_connection = get_connection()
+    mail_connection.open()
+    total = 0
+    try:
+        while True:
+            with transaction.atomic():
+                batch = _due_batch(batch_size)
+                if not batch:
+                    break
+                total += _send_batch(batch, mail_connection, site_url)
+    finally:
+        mail_connection.close()
+    return total
@@ -4,6 +4,7 @@ by sopelkin
 """
 
 from django import forms
+from django.db.models.query import QuerySet
 from django.forms import widgets
 from django.utils.translation import ugettext_lazy as _
 
@@ -24,6 +25,31 @@ class CommaSeparatedUserInput(widgets.Input):
 
 
 
+class RecipientFilter(object):
+    """
+    A set-based recipient filter. Instead of checking one user at a time,
+    ``filter`` receives all recipients at once and narrows them down to the
+    allowed ones within the same query. Pass a ``Q`` object with the
+    conditions for allowed users, or subclass and override ``filter``.
+    """
+    def __init__(self, q=None):
+        self.q = q
+
+    def filter(self, users):
+        """
+        Returns the allowed users of ``users`` (a queryset of users or a list
+        of user ids) as a queryset.
+        """
+        if not isinstance(users, QuerySet):
+            users = User.objects.filter(pk__in=users)
+        if self.q is not None:
+            users = users.filter(self.q)
+        return users
+
+    def __call__(self, user):
+        return self.filter([user.pk]).exists()
+
+
 class CommaSeparatedUserField(forms.Field):
     widget = CommaSeparatedUserInput
 
@@ -39,21 +65,24 @@ class CommaSeparatedUserField(forms.Field):
         if isinstance(value, (list, tuple)):
             return value
 
-        names = set(value.split(','))
-        names_set = set([name.strip() for name in names if name.strip()])
-        users = list(User.objects.filter(**{'%s__in' % get_username_field(): names_set}))
-        unknown_names = names_set ^ set([getattr(user, get_username_field()) for user in users])
+        username_field = get_username_field()
+        names_set = set(name.strip() for name in value.split(','))
+        names_set.discard('')
+        users = User.objects.filter(**{'%s__in' % username_field: names_set})
 
         recipient_filter = self._recipient_filter
-        invalid_users = []
-        if recipient_filter is not None:
-            for r in users:
-                if recipient_filter(r) is False:
-                    users.remove(r)
-                    invalid_users.append(getattr(r, get_username_field()))
-
-        if unknown_names or invalid_users:
-            raise forms.ValidationError(_(u"The following usernames are incorrect: %(users)s") % {'users': ', '.join(list(unknown_names)+invalid_users)})
+        if isinstance(recipient_filter, RecipientFilter):
+            users = list(recipient_filter.filter(users))
+        else:
+            users = list(users)
+            if recipient_filter is not None:
+                users = [r for r in users if recipient_filter(r) is not False]
+
+        # unknown and filtered out usernames alike
+        invalid_names = names_set - set(
+            getattr(user, username_field) for user in users)
+        if invalid_names:
+            raise forms.ValidationError(_(u"The following usernames are incorrect: %(users)s") % {'users': ', '.join(sorted(invalid_names))})
 
         return users
 
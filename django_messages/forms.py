@@ -1,7 +1,6 @@
 from django import forms
 from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
-from django.utils import timezone
 
 if "pinax.notifications" in settings.INSTALLED_APPS and getattr(settings, 'DJANGO_MESSAGES_NOTIFY', True):
     from pinax.notifications import models as notification
@@ -10,6 +9,7 @@ else:
 
 from django_messages.models import Message
 from django_messages.fields import CommaSeparatedUserField
+from django_messages.instrumentation import instrumented
 
 class ComposeForm(forms.Form):
     """
@@ -28,24 +28,15 @@ class ComposeForm(forms.Form):
             self.fields['recipient']._recipient_filter = recipient_filter
 
 
+    @instrumented('forms.compose', rows=len)
     def save(self, sender, parent_msg=None):
         recipients = self.cleaned_data['recipient']
         subject = self.cleaned_data['subject']
         body = self.cleaned_data['body']
-        message_list = []
-        for r in recipients:
-            msg = Message(
-                sender = sender,
-                recipient = r,
-                subject = subject,
-                body = body,
-            )
-            if parent_msg is not None:
-                msg.parent_msg = parent_msg
-                parent_msg.replied_at = timezone.now()
-                parent_msg.save()
-            msg.save()
-            message_list.append(msg)
+        message_list = Message.objects.send(
+            sender, recipients, subject, body, parent_msg=parent_msg)
+        for msg in message_list:
+            r = msg.recipient
             if notification:
                 if parent_msg is not None:
                     notification.send([sender], "messages_replied", {'message': msg,})
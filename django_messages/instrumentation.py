@@ -0,0 +1,127 @@
+"""
+Timings and query counts of the django-messages operations.
+
+Every instrumented operation (manager methods which change or count
+messages, views, the compose form, email notifications, broadcasts and
+management commands) emits an event to the sinks listed in
+``DJANGO_MESSAGES_INSTRUMENTATION_SINKS``::
+
+    {'operation': 'messages.send', 'duration_ms': 12.5, 'queries': 4,
+     'rows': 20, 'error': None}
+
+``rows`` is the number of messages the operation returned or changed, if
+that applies. A sink is a class with an ``emit(event)`` method. Without
+sinks the operations run uninstrumented.
+"""
+import logging
+from contextlib import contextmanager
+from functools import wraps
+from timeit import default_timer
+
+from django.conf import settings
+from django.db import connection
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger('django_messages.instrumentation')
+
+_sinks = (None, [])
+
+
+class LoggingSink(object):
+    """
+    Logs every event to the ``django_messages.instrumentation`` logger.
+    """
+    def emit(self, event):
+        logger.info(
+            '%(operation)s: %(duration_ms).1f ms, %(queries)d queries',
+            event, extra={'event': event})
+
+
+class MemorySink(object):
+    """
+    Collects the events in ``MemorySink.events``, e.g. for tests.
+    """
+    events = []
+
+    def emit(self, event):
+        self.events.append(event)
+
+    @classmethod
+    def clear(cls):
+        del cls.events[:]
+
+
+def get_sinks():
+    global _sinks
+    paths = tuple(getattr(settings, 'DJANGO_MESSAGES_INSTRUMENTATION_SINKS', ()))
+    if _sinks[0] != paths:
+        _sinks = (paths, [import_string(path)() for path in paths])
+    return _sinks[1]
+
+
+class Operation(object):
+    """
+    A running operation. Counts the queries executed on the default
+    database connection; set ``rows`` to report the number of affected
+    messages.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.queries = 0
+        self.rows = None
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+
+@contextmanager
+def operation(name):
+    """
+    Measures the enclosed block as operation ``name``::
+
+        with operation('messages.cleanup') as op:
+            op.rows = queryset.delete()[0]
+    """
+    op = Operation(name)
+    sinks = get_sinks()
+    if not sinks:
+        yield op
+        return
+    error = None
+    start = default_timer()
+    try:
+        with connection.execute_wrapper(op):
+            yield op
+    except Exception as e:
+        error = e.__class__.__name__
+        raise
+    finally:
+        event = {
+            'operation': name,
+            'duration_ms': (default_timer() - start) * 1000,
+            'queries': op.queries,
+            'rows': op.rows,
+            'error': error,
+        }
+        for sink in sinks:
+            sink.emit(event)
+
+
+def instrumented(name, rows=None):
+    """
+    Decorates a function to be measured as operation ``name``. ``rows`` is
+    called with the return value to get the number of affected messages,
+    e.g. ``len`` or ``int``.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with operation(name) as op:
+                result = func(*args, **kwargs)
+                if rows is not None:
+                    op.rows = rows(result)
+            return result
+        return wrapper
+    return decorator
+
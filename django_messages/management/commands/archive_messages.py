@@ -0,0 +1,66 @@
+import datetime
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from ...instrumentation import instrumented
+from ...models import ArchivedMessage, Message
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+class Command(BaseCommand):
+    help = (
+        'Moves conversations without any message newer than the given age in '
+        'days into the archive.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('age', type=int)
+        parser.add_argument(
+            '--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+            help='Number of messages archived per transaction (default: %d).'
+                 % DEFAULT_BATCH_SIZE)
+        parser.add_argument(
+            '--sleep', type=float, default=0,
+            help='Seconds to wait between two batches, to reduce the load '
+                 'on the database.')
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only report how many messages would be archived.')
+
+    @instrumented('commands.archive_messages')
+    def handle(self, *args, **options):
+        if not options['age']:
+            raise CommandError('You must provide the minimum age in days.')
+        if options['batch_size'] < 1:
+            raise CommandError('The batch size must be a positive integer.')
+
+        the_date = timezone.now() - datetime.timedelta(days=options['age'])
+        messages = Message.objects.archivable(the_date).order_by()
+
+        if options['dry_run']:
+            self.stdout.write('%d messages would be archived.'
+                              % messages.count())
+            return
+
+        total = 0
+        last_pk = None
+        while True:
+            # newest first, so replies are moved before their parents and
+            # never lose ``parent_msg`` to the SET_NULL of a moved parent
+            batch = messages.order_by('-pk')
+            if last_pk is not None:
+                batch = batch.filter(pk__lt=last_pk)
+            ids = list(batch.values_list('pk', flat=True)
+                       [:options['batch_size']])
+            if not ids:
+                break
+            last_pk = ids[-1]
+            total += ArchivedMessage.objects.archive(
+                messages.filter(pk__in=ids))
+            if options['verbosity'] > 1:
+                self.stdout.write('Archived %d messages' % total)
+            if options['sleep']:
+                time.sleep(options['sleep'])
+        if options['verbosity']:
+            self.stdout.write('Archived %d messages.' % total)
@@ -1,7 +1,14 @@
 import datetime
+import time
 from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
 from django.utils import timezone
-from ...models import Message
+from ...cache import bump_mailbox_versions
+from ...instrumentation import instrumented
+from ...models import (MailboxCounters, Message, counters_enabled,
+    participant_ids)
+
+DEFAULT_BATCH_SIZE = 1000
 
 
 class Command(BaseCommand):
@@ -13,7 +20,19 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('age', type=int)
+        parser.add_argument(
+            '--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+            help='Number of messages deleted per transaction (default: %d).'
+                 % DEFAULT_BATCH_SIZE)
+        parser.add_argument(
+            '--sleep', type=float, default=0,
+            help='Seconds to wait between two batches, to reduce the load '
+                 'on the database.')
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only report how many messages would be deleted.')
 
+    @instrumented('commands.delete_deleted_messages')
     def handle(self, *args, **options):
         if not options['age']:
             raise CommandError('You must provide the minimum age in days.')
@@ -23,9 +42,54 @@ class Command(BaseCommand):
         except ValueError:
             raise CommandError('"%s" is not an integer.' % options['age'])
 
+        if options['batch_size'] < 1:
+            raise CommandError('The batch size must be a positive integer.')
+
         the_date = timezone.now() - datetime.timedelta(days=age_in_days)
 
-        Message.objects.filter(
+        messages = Message.objects.filter(
             recipient_deleted_at__lte=the_date,
             sender_deleted_at__lte=the_date,
-        ).delete()
+        ).order_by()
+
+        if options['dry_run']:
+            replies = Message.objects.filter(parent_msg__in=messages).exclude(
+                pk__in=messages)
+            self.stdout.write(
+                '%d messages would be deleted, %d replies would lose their '
+                'parent message.' % (messages.count(), replies.count()))
+            return
+
+        total = 0
+        last_pk = 0
+        while True:
+            ids = list(messages.filter(pk__gt=last_pk).order_by('pk')
+                       .values_list('pk', flat=True)[:options['batch_size']])
+            if not ids:
+                break
+            last_pk = ids[-1]
+            total += self.delete_batch(messages.filter(pk__in=ids))
+            if options['verbosity'] > 1:
+                self.stdout.write('Deleted %d messages' % total)
+            if options['sleep']:
+                time.sleep(options['sleep'])
+        if options['verbosity']:
+            self.stdout.write('Deleted %d messages.' % total)
+
+    def delete_batch(self, batch):
+        """
+        Deletes the messages of ``batch`` in one transaction and returns
+        their number. References of replies to these messages are cleared
+        with a single UPDATE beforehand, so Django doesn't have to load the
+        replies to apply ``SET_NULL``.
+        """
+        user_ids = participant_ids(batch)
+        with transaction.atomic():
+            ids = list(batch.values_list('pk', flat=True))
+            batch = Message.objects.filter(pk__in=ids)
+            if counters_enabled():
+                MailboxCounters.objects.discount(batch)
+            Message.objects.filter(parent_msg__in=ids).update(parent_msg=None)
+            count = batch.delete()[1].get(Message._meta.label, 0)
+        bump_mailbox_versions(user_ids)
+        return count
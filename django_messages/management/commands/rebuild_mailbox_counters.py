@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from ...cache import bump_mailbox_versions
+from ...instrumentation import instrumented
+from ...models import MailboxCounters
+from ...utils import get_user_model
+
+
+class Command(BaseCommand):
+    help = (
+        'Recalculates the denormalized mailbox counters of all users (or the '
+        'given user ids) from the messages table.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('user_ids', nargs='*', type=int)
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of users recounted per transaction.')
+
+    @instrumented('commands.rebuild_mailbox_counters')
+    def handle(self, *args, **options):
+        user_ids = options['user_ids']
+        if not user_ids:
+            user_ids = get_user_model().objects.order_by('pk').values_list(
+                'pk', flat=True).iterator()
+        batch_size = options['batch_size']
+        batch = []
+        total = 0
+        for user_id in user_ids:
+            batch.append(user_id)
+            if len(batch) >= batch_size:
+                total += self._rebuild(batch)
+                batch = []
+        if batch:
+            total += self._rebuild(batch)
+        if options['verbosity'] > 0:
+            self.stdout.write('Rebuilt mailbox counters of %d users.' % total)
+
+    def _rebuild(self, user_ids):
+        with transaction.atomic():
+            MailboxCounters.objects.rebuild(user_ids=user_ids)
+        bump_mailbox_versions(user_ids)
+        return len(user_ids)
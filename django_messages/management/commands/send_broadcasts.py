@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from ...broadcast import run_pending_broadcasts
+from ...instrumentation import instrumented
+
+
+class Command(BaseCommand):
+    help = (
+        'Sends all pending admin broadcasts to groups or all users. '
+        'Interrupted broadcasts are continued where they stopped.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size', type=int, default=None,
+            help='Number of recipients handled per transaction.')
+
+    @instrumented('commands.send_broadcasts')
+    def handle(self, *args, **options):
+        count = run_pending_broadcasts(options['chunk_size'])
+        if options['verbosity'] > 0:
+            self.stdout.write('Processed %d broadcasts.' % count)
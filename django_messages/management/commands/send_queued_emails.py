@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from ...email_queue import send_queued_emails
+from ...instrumentation import instrumented
+
+
+class Command(BaseCommand):
+    help = (
+        'Sends the queued email notifications about new messages '
+        '(requires DJANGO_MESSAGES_EMAIL_QUEUE = True).'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=None,
+            help='Number of emails sent per transaction.')
+
+    @instrumented('commands.send_queued_emails')
+    def handle(self, *args, **options):
+        count = send_queued_emails(options['batch_size'])
+        if options['verbosity'] > 0:
+            self.stdout.write('Sent %d emails.' % count)
@@ -0,0 +1,27 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:37
+
+from django.db import migrations, models
+
+from django_messages.operations import AddPartialIndex
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_messages', '0003_auto_20190617_1316'),
+    ]
+
+    operations = [
+        AddPartialIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(recipient_deleted_at__isnull=True), fields=['recipient', '-sent_at'], name='messages_inbox_idx'),
+        ),
+        AddPartialIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('read_at__isnull', True), ('recipient_deleted_at__isnull', True)), fields=['recipient', '-sent_at'], name='messages_unread_idx'),
+        ),
+        AddPartialIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(sender_deleted_at__isnull=True), fields=['sender', '-sent_at'], name='messages_outbox_idx'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:39
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('django_messages', '0004_mailbox_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MailboxCounters',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='mailbox_counters', serialize=False, to=settings.AUTH_USER_MODEL, verbose_name='User')),
+                ('unread', models.IntegerField(default=0, verbose_name='unread messages')),
+                ('inbox', models.IntegerField(default=0, verbose_name='messages in inbox')),
+                ('outbox', models.IntegerField(default=0, verbose_name='messages in outbox')),
+                ('trash', models.IntegerField(default=0, verbose_name='messages in trash')),
+            ],
+            options={
+                'verbose_name': 'Mailbox counters',
+                'verbose_name_plural': 'Mailbox counters',
+            },
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:41
+
+from django.db import migrations, models
+
+from django_messages.operations import AddPartialIndex, RemovePartialIndex
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_messages', '0005_mailboxcounters'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='message',
+            options={'ordering': ['-sent_at', '-id'], 'verbose_name': 'Message', 'verbose_name_plural': 'Messages'},
+        ),
+        RemovePartialIndex(
+            model_name='message',
+            name='messages_inbox_idx',
+        ),
+        RemovePartialIndex(
+            model_name='message',
+            name='messages_unread_idx',
+        ),
+        RemovePartialIndex(
+            model_name='message',
+            name='messages_outbox_idx',
+        ),
+        AddPartialIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(recipient_deleted_at__isnull=True), fields=['recipient', '-sent_at', '-id'], name='messages_inbox_idx'),
+        ),
+        AddPartialIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('read_at__isnull', True), ('recipient_deleted_at__isnull', True)), fields=['recipient', '-sent_at', '-id'], name='messages_unread_idx'),
+        ),
+        AddPartialIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(sender_deleted_at__isnull=True), fields=['sender', '-sent_at', '-id'], name='messages_outbox_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:43
+
+from django.db import migrations, models
+
+from django_messages.operations import AddPartialIndex
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_messages', '0006_keyset_ordering'),
+    ]
+
+    operations = [
+        AddPartialIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(recipient_deleted_at__isnull=False), fields=['recipient', '-sent_at', '-id'], name='messages_trash_received_idx'),
+        ),
+        AddPartialIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(sender_deleted_at__isnull=False), fields=['sender', '-sent_at', '-id'], name='messages_trash_sent_idx'),
+        ),
+    ]
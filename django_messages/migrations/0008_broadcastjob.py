@@ -0,0 +1,41 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:46
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('auth', '0001_initial'),
+        ('django_messages', '0007_trash_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BroadcastJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subject', models.CharField(max_length=140, verbose_name='Subject')),
+                ('body', models.TextField(verbose_name='Body')),
+                ('status', models.CharField(choices=[('pending', 'pending'), ('running', 'running'), ('done', 'done')], default='pending', max_length=10, verbose_name='status')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='created at')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='finished at')),
+                ('last_user_pk', models.CharField(blank=True, editable=False, max_length=255, verbose_name='last recipient')),
+                ('sent_count', models.PositiveIntegerField(default=0, verbose_name='sent messages')),
+                ('total', models.PositiveIntegerField(blank=True, null=True, verbose_name='recipients')),
+                ('exclude_user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='excluded user')),
+                ('group', models.ForeignKey(blank=True, help_text='Leave empty to send the message to all users.', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='auth.Group', verbose_name='group')),
+                ('parent_msg', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='django_messages.Message', verbose_name='Parent message')),
+                ('sender', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='Sender')),
+            ],
+            options={
+                'verbose_name': 'Broadcast',
+                'verbose_name_plural': 'Broadcasts',
+                'ordering': ['created_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:48
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_messages', '0008_broadcastjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueuedEmail',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='created at')),
+                ('next_attempt_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='next attempt at')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='attempts')),
+                ('last_error', models.TextField(blank=True, verbose_name='last error')),
+                ('failed_at', models.DateTimeField(blank=True, null=True, verbose_name='failed at')),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='django_messages.Message', verbose_name='Message')),
+            ],
+            options={
+                'verbose_name': 'Queued email',
+                'verbose_name_plural': 'Queued emails',
+                'ordering': ['next_attempt_at', 'id'],
+            },
+        ),
+    ]
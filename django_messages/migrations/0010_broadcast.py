@@ -0,0 +1,53 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:49
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('django_messages', '0009_queuedemail'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Broadcast',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subject', models.CharField(max_length=140, verbose_name='Subject')),
+                ('body', models.TextField(verbose_name='Body')),
+                ('sent_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='sent at')),
+                ('group', models.ForeignKey(blank=True, help_text='Leave empty to send the message to all users.', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='auth.Group', verbose_name='group')),
+                ('sender', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='Sender')),
+            ],
+            options={
+                'verbose_name': 'Broadcast message',
+                'verbose_name_plural': 'Broadcast messages',
+                'ordering': ['-sent_at', '-id'],
+            },
+        ),
+        migrations.CreateModel(
+            name='BroadcastState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('read_at', models.DateTimeField(blank=True, null=True, verbose_name='read at')),
+                ('deleted_at', models.DateTimeField(blank=True, null=True, verbose_name='deleted at')),
+                ('broadcast', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='states', to='django_messages.Broadcast', verbose_name='Broadcast message')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='User')),
+            ],
+            options={
+                'verbose_name': 'Broadcast state',
+                'verbose_name_plural': 'Broadcast states',
+                'unique_together': {('user', 'broadcast')},
+            },
+        ),
+        migrations.AddIndex(
+            model_name='broadcast',
+            index=models.Index(fields=['-sent_at', '-id'], name='messages_broadcast_idx'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_messages', '0010_broadcast'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='depth',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='depth'),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='thread_root',
+            field=models.PositiveIntegerField(blank=True, editable=False, help_text='The id of the first message of the conversation, empty for the first message itself.', null=True, verbose_name='thread root'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['thread_root', 'sent_at'], name='messages_thread_idx'),
+        ),
+    ]
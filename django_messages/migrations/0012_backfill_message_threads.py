@@ -0,0 +1,48 @@
+from django.db import migrations, models
+from django.db.models import Case, Value, When
+
+# parents per UPDATE, keeps the statements below SQLite's variable limit
+BATCH_SIZE = 300
+
+
+def backfill_threads(apps, schema_editor):
+    """
+    Sets ``thread_root`` and ``depth`` of all replies, one level of the
+    ``parent_msg`` trees at a time. The parents of each level are read
+    first and the replies updated with literal ids, as MySQL can't update a
+    table which the same statement reads in a subquery.
+    """
+    Message = apps.get_model('django_messages', 'Message')
+    parents = Message.objects.filter(
+        next_messages__isnull=False).order_by().distinct()
+    level = list(parents.filter(parent_msg__isnull=True).values_list(
+        'pk', 'thread_root'))
+    depth = 1
+    while level:
+        for i in range(0, len(level), BATCH_SIZE):
+            batch = level[i:i + BATCH_SIZE]
+            by_root = {}
+            for pk, root in batch:
+                by_root.setdefault(root or pk, []).append(pk)
+            Message.objects.filter(
+                parent_msg__in=[pk for pk, root in batch],
+            ).update(
+                thread_root=Case(
+                    *[When(parent_msg__in=pks, then=Value(root))
+                      for root, pks in by_root.items()],
+                    output_field=models.PositiveIntegerField()),
+                depth=depth)
+        level = list(parents.filter(depth=depth).values_list(
+            'pk', 'thread_root'))
+        depth += 1
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_messages', '0011_message_thread'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_threads, migrations.RunPython.noop),
+    ]
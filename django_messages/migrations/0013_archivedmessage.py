@@ -0,0 +1,53 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:58
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('django_messages', '0012_backfill_message_threads'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedMessage',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('subject', models.CharField(max_length=140, verbose_name='Subject')),
+                ('body', models.TextField(verbose_name='Body')),
+                ('parent_id', models.PositiveIntegerField(blank=True, null=True, verbose_name='Parent message')),
+                ('sent_at', models.DateTimeField(blank=True, null=True, verbose_name='sent at')),
+                ('read_at', models.DateTimeField(blank=True, null=True, verbose_name='read at')),
+                ('replied_at', models.DateTimeField(blank=True, null=True, verbose_name='replied at')),
+                ('sender_deleted_at', models.DateTimeField(blank=True, null=True, verbose_name='Sender deleted at')),
+                ('recipient_deleted_at', models.DateTimeField(blank=True, null=True, verbose_name='Recipient deleted at')),
+                ('thread_root', models.PositiveIntegerField(blank=True, null=True, verbose_name='thread root')),
+                ('depth', models.PositiveIntegerField(default=0, verbose_name='depth')),
+                ('archived_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='archived at')),
+                ('recipient', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='Recipient')),
+                ('sender', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='Sender')),
+            ],
+            options={
+                'verbose_name': 'Archived message',
+                'verbose_name_plural': 'Archived messages',
+                'ordering': ['-sent_at', '-id'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='archivedmessage',
+            index=models.Index(fields=['recipient', '-sent_at', '-id'], name='messages_archive_inbox_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedmessage',
+            index=models.Index(fields=['sender', '-sent_at', '-id'], name='messages_archive_outbox_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedmessage',
+            index=models.Index(fields=['thread_root', 'sent_at'], name='messages_archive_thread_idx'),
+        ),
+    ]
@@ -0,0 +1,62 @@
+from django.db import OperationalError, migrations
+
+from django_messages.search import SQLITE_REBUILD, SQLITE_TRIGGERS
+
+SQLITE_FTS = [
+    "CREATE VIRTUAL TABLE django_messages_message_fts USING fts5("
+    "subject, body, content='django_messages_message', content_rowid='id')",
+] + [SQLITE_TRIGGERS[name] for name in sorted(SQLITE_TRIGGERS)] + [
+    SQLITE_REBUILD,
+]
+
+SQLITE_FTS_REVERSE = [
+    "DROP TRIGGER IF EXISTS django_messages_message_fts_insert",
+    "DROP TRIGGER IF EXISTS django_messages_message_fts_delete",
+    "DROP TRIGGER IF EXISTS django_messages_message_fts_update",
+    "DROP TABLE IF EXISTS django_messages_message_fts",
+]
+
+POSTGRES_INDEX = [
+    "CREATE INDEX messages_search_idx ON django_messages_message "
+    "USING GIN (to_tsvector('simple', subject || ' ' || body))",
+]
+
+POSTGRES_INDEX_REVERSE = [
+    "DROP INDEX IF EXISTS messages_search_idx",
+]
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        try:
+            schema_editor.execute(SQLITE_FTS[0])
+        except OperationalError:
+            # SQLite was built without FTS5, search falls back to icontains
+            return
+        for sql in SQLITE_FTS[1:]:
+            schema_editor.execute(sql)
+    elif vendor == 'postgresql':
+        for sql in POSTGRES_INDEX:
+            schema_editor.execute(sql)
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        for sql in SQLITE_FTS_REVERSE:
+            schema_editor.execute(sql)
+    elif vendor == 'postgresql':
+        for sql in POSTGRES_INDEX_REVERSE:
+            schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_messages', '0013_archivedmessage'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
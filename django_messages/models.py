@@ -3,14 +3,101 @@ try:
     from django.core.urlresolvers import reverse
 except ImportError:
     from django.urls import reverse
-from django.db import models
-from django.db.models import signals
+from django.db import models, transaction
+from django.db.models import (Count, Exists, F, OuterRef, Q, Subquery,
+    signals)
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.translation import ugettext_lazy as _
 
+from django_messages.cache import SHARED, bump_mailbox_versions, cached_for
+from django_messages.changes import publish_new_message
+from django_messages.instrumentation import instrumented
+from django_messages.search import get_search_backend
+from django_messages.signals import (messages_deleted, messages_read,
+    messages_restored, messages_sent)
+
 AUTH_USER_MODEL = getattr(settings, 'AUTH_USER_MODEL', 'auth.User')
 
+COUNTER_FIELDS = ('unread', 'inbox', 'outbox', 'trash')
+
+# the fields of a message which determine its mailbox state
+MAILBOX_STATE_FIELDS = ('sender_id', 'recipient_id', 'read_at',
+                        'sender_deleted_at', 'recipient_deleted_at')
+
+
+def counters_enabled():
+    """
+    Returns whether the denormalized ``MailboxCounters`` are maintained and
+    used to answer the unread-count.
+    """
+    return getattr(settings, 'DJANGO_MESSAGES_COUNTERS', False)
+
+
+def email_queue_enabled():
+    """
+    Returns whether the email notifications about new messages are queued
+    (see ``django_messages.email_queue``) instead of sent on save.
+    """
+    return ("pinax.notifications" not in settings.INSTALLED_APPS and
+            getattr(settings, 'DJANGO_MESSAGES_NOTIFY', True) and
+            getattr(settings, 'DJANGO_MESSAGES_EMAIL_QUEUE', False))
+
+
+def _mailbox_state(sender_id, recipient_id, read_at, sender_deleted_at,
+                   recipient_deleted_at):
+    """
+    Returns how a message with the given state contributes to the mailbox
+    counters of its sender and recipient as ``{user_id: {field: n}}``.
+    """
+    state = {}
+    for user_id in set([sender_id, recipient_id]):
+        if user_id is None:
+            continue
+        is_recipient = user_id == recipient_id
+        is_sender = user_id == sender_id
+        in_inbox = is_recipient and recipient_deleted_at is None
+        state[user_id] = {
+            'unread': int(in_inbox and read_at is None),
+            'inbox': int(in_inbox),
+            'outbox': int(is_sender and sender_deleted_at is None),
+            'trash': int(
+                (is_recipient and recipient_deleted_at is not None) or
+                (is_sender and sender_deleted_at is not None)),
+        }
+    return state
+
+
+def _state_deltas(before, after):
+    """
+    Returns the counter changes needed to get from the ``before`` to the
+    ``after`` mailbox state (both as returned by ``_mailbox_state``).
+    """
+    deltas = {}
+    for user_id in set(before) | set(after):
+        old = before.get(user_id, {})
+        new = after.get(user_id, {})
+        delta = dict(
+            (field, new.get(field, 0) - old.get(field, 0))
+            for field in COUNTER_FIELDS)
+        if any(delta.values()):
+            deltas[user_id] = delta
+    return deltas
+
+
+def _combined_state(messages):
+    """
+    Returns the summed mailbox state of all given messages.
+    """
+    combined = {}
+    for message in messages:
+        for user_id, state in message.mailbox_state().items():
+            totals = combined.setdefault(user_id, {})
+            for field, value in state.items():
+                totals[field] = totals.get(field, 0) + value
+    return combined
+
 
 class MessageManager(models.Manager):
 
@@ -34,19 +121,327 @@ class MessageManager(models.Manager):
             sender_deleted_at__isnull=True,
         )
 
-    def trash_for(self, user):
+    def unread_for(self, user):
         """
-        Returns all messages that were either received or sent by the given
-        user and are marked as deleted.
+        Returns all messages in the inbox of the given user which have not
+        been read yet.
+        """
+        return self.filter(
+            recipient=user,
+            read_at__isnull=True,
+            recipient_deleted_at__isnull=True,
+        )
+
+    def trash_received_for(self, user):
+        """
+        Returns all messages that were received by the given user and are
+        marked as deleted by the recipient.
         """
         return self.filter(
             recipient=user,
             recipient_deleted_at__isnull=False,
-        ) | self.filter(
+        )
+
+    def trash_sent_for(self, user):
+        """
+        Returns all messages that were sent by the given user and are marked
+        as deleted by the sender.
+        """
+        return self.filter(
             sender=user,
             sender_deleted_at__isnull=False,
         )
 
+    def trash_for(self, user):
+        """
+        Returns all messages that were either received or sent by the given
+        user and are marked as deleted.
+
+        The combined condition can't be answered from a single index. To
+        list the trash of large mailboxes paginate the querysets of
+        ``trash_received_for`` and ``trash_sent_for`` together instead (see
+        ``django_messages.pagination.paginate``).
+        """
+        return self.trash_received_for(user) | self.trash_sent_for(user)
+
+    def thread_for(self, user, message):
+        """
+        Returns all messages of the conversation ``message`` (a message or
+        its id) belongs to, which were sent or received by the given user,
+        in chronological order. This is a single query on the
+        ``thread_root`` index.
+        """
+        message_id = getattr(message, 'pk', message)
+        root = self.filter(pk=message_id).annotate(
+            root=Coalesce('thread_root', 'id',
+                          output_field=models.IntegerField())).values('root')
+        return self.filter(
+            Q(thread_root=Subquery(root)) | Q(pk=Subquery(root)),
+            Q(sender=user) | Q(recipient=user),
+        ).order_by('sent_at', 'id')
+
+    def search_for(self, user, query):
+        """
+        Returns the messages in the inbox and outbox of the given user which
+        match the search ``query``, using the full-text index of the
+        database if there is one (see ``django_messages.search``).
+        """
+        messages = self.filter(
+            Q(recipient=user, recipient_deleted_at__isnull=True) |
+            Q(sender=user, sender_deleted_at__isnull=True))
+        return get_search_backend(messages.db).search(messages, query)
+
+    def archivable(self, before):
+        """
+        Returns the messages of all conversations in which no message was
+        sent on or after ``before``. Conversations are only archived as a
+        whole, so ``parent_msg`` of the remaining messages stays intact.
+        """
+        recent = self.filter(sent_at__gte=before).annotate(
+            root=Coalesce('thread_root', 'id',
+                          output_field=models.IntegerField())).values('root')
+        return self.filter(sent_at__lt=before).exclude(
+            thread_root__in=recent).exclude(pk__in=recent)
+
+    def _changed_for(self, user):
+        """
+        Brings the counters and cache of the given user up to date after a
+        set-based change of the user's messages.
+        """
+        if counters_enabled():
+            MailboxCounters.objects.rebuild(user_ids=[user.pk])
+        bump_mailbox_versions([user.pk])
+
+    def _affected(self, signal, querysets):
+        """
+        Returns the messages which the given querysets will change, if
+        ``signal`` has receivers which need to be told about them.
+        """
+        if not signal.has_listeners(self.model):
+            return None
+        affected = {}
+        for queryset in querysets:
+            for message in queryset:
+                affected[message.pk] = message
+        return [affected[pk] for pk in sorted(affected)]
+
+    def _notify(self, signal, messages, user):
+        if messages:
+            signal.send(sender=self.model, messages=messages, user=user)
+
+    @instrumented('messages.delete_for', rows=int)
+    def delete_for(self, user, messages):
+        """
+        Marks all of the given messages (a queryset) which the user sent or
+        received as deleted by the user, with one UPDATE per role. Returns
+        the number of changed messages.
+        """
+        now = timezone.now()
+        received = messages.filter(
+            recipient=user, recipient_deleted_at__isnull=True)
+        sent = messages.filter(sender=user, sender_deleted_at__isnull=True)
+        with transaction.atomic(using=self.db):
+            affected = self._affected(messages_deleted, [received, sent])
+            # messages to oneself are changed by both updates
+            count = -received.filter(
+                sender=user, sender_deleted_at__isnull=True).count()
+            count += received.update(recipient_deleted_at=now)
+            count += sent.update(sender_deleted_at=now)
+            self._changed_for(user)
+        self._notify(messages_deleted, affected, user)
+        return count
+
+    @instrumented('messages.undelete_for', rows=int)
+    def undelete_for(self, user, messages):
+        """
+        Recovers all of the given messages (a queryset) which the user
+        deleted. Returns the number of changed messages.
+        """
+        received = messages.filter(
+            recipient=user, recipient_deleted_at__isnull=False)
+        sent = messages.filter(sender=user, sender_deleted_at__isnull=False)
+        with transaction.atomic(using=self.db):
+            affected = self._affected(messages_restored, [received, sent])
+            # messages to oneself are changed by both updates
+            count = -received.filter(
+                sender=user, sender_deleted_at__isnull=False).count()
+            count += received.update(recipient_deleted_at=None)
+            count += sent.update(sender_deleted_at=None)
+            self._changed_for(user)
+        self._notify(messages_restored, affected, user)
+        return count
+
+    @instrumented('messages.mark_read_for', rows=int)
+    def mark_read_for(self, user, messages):
+        """
+        Marks all of the given messages (a queryset) which the user received
+        as read. Returns the number of changed rows.
+        """
+        unread = messages.filter(recipient=user, read_at__isnull=True)
+        with transaction.atomic(using=self.db):
+            affected = self._affected(messages_read, [unread])
+            count = unread.update(read_at=timezone.now())
+            self._changed_for(user)
+        self._notify(messages_read, affected, user)
+        return count
+
+    @instrumented('messages.mark_unread_for', rows=int)
+    def mark_unread_for(self, user, messages):
+        """
+        Marks all of the given messages (a queryset) which the user received
+        as unread. Returns the number of changed rows.
+        """
+        with transaction.atomic(using=self.db):
+            count = messages.filter(
+                recipient=user, read_at__isnull=False,
+            ).update(read_at=None)
+            self._changed_for(user)
+        return count
+
+    def _transition(self, message, condition, values, previous):
+        """
+        Writes ``values`` to the row of ``message`` with one UPDATE, if the
+        row still matches ``condition``. ``previous`` holds the values the
+        changed fields had for the condition to match, to derive the counter
+        changes. Returns whether the row was changed.
+        """
+        with transaction.atomic(using=self.db):
+            if not self.filter(condition, pk=message.pk).update(**values):
+                return False
+            if counters_enabled() and previous:
+                state = self.filter(pk=message.pk).values(
+                    'sender_id', 'recipient_id', 'read_at',
+                    'sender_deleted_at', 'recipient_deleted_at').get()
+                after = _mailbox_state(**state)
+                state.update(previous)
+                MailboxCounters.objects.apply(
+                    _state_deltas(_mailbox_state(**state), after))
+        for field, value in values.items():
+            setattr(message, field, value)
+        message._loaded_mailbox_state = message.mailbox_state()
+        bump_mailbox_versions([message.sender_id, message.recipient_id])
+        return True
+
+    @instrumented('messages.mark_read', rows=int)
+    def mark_read(self, message):
+        """
+        Marks the message as read unless it was read before. Returns whether
+        the message changed.
+        """
+        changed = self._transition(
+            message, Q(read_at__isnull=True),
+            {'read_at': timezone.now()}, {'read_at': None})
+        if changed:
+            self._notify(messages_read, [message], message.recipient)
+        return changed
+
+    @instrumented('messages.mark_replied', rows=int)
+    def mark_replied(self, message, replied_at=None):
+        """
+        Sets ``replied_at`` of the message unless it already holds a later
+        reply. Returns whether the message changed.
+        """
+        if replied_at is None:
+            replied_at = timezone.now()
+        return self._transition(
+            message,
+            Q(replied_at__isnull=True) | Q(replied_at__lt=replied_at),
+            {'replied_at': replied_at}, None)
+
+    @instrumented('messages.mark_deleted_for', rows=int)
+    def mark_deleted_for(self, message, user):
+        """
+        Moves the message to the trash of the user, who may be its sender,
+        its recipient or both. Returns whether the message changed.
+        """
+        now = timezone.now()
+        changed = False
+        for role in ('sender', 'recipient'):
+            if getattr(message, '%s_id' % role) == user.pk:
+                field = '%s_deleted_at' % role
+                changed |= self._transition(
+                    message, Q(**{'%s__isnull' % field: True}),
+                    {field: now}, {field: None})
+        if changed:
+            self._notify(messages_deleted, [message], user)
+        return changed
+
+    @instrumented('messages.restore_for', rows=int)
+    def restore_for(self, message, user):
+        """
+        Recovers the message from the trash of the user. Returns whether the
+        message changed.
+        """
+        changed = False
+        for role in ('sender', 'recipient'):
+            if getattr(message, '%s_id' % role) == user.pk:
+                field = '%s_deleted_at' % role
+                changed |= self._transition(
+                    message, Q(**{'%s__isnull' % field: False}),
+                    {field: None}, {field: timezone.now()})
+        if changed:
+            self._notify(messages_restored, [message], user)
+        return changed
+
+    @instrumented('messages.send', rows=len)
+    def send(self, sender, recipients, subject, body, parent_msg=None):
+        """
+        Creates one message from ``sender`` to each of the ``recipients`` with
+        a single bulk insert in one transaction and marks ``parent_msg`` (if
+        given) as replied. Returns the list of created messages.
+
+        ``post_save`` is sent for every created message after the rows were
+        written, so receivers like the email notification keep working,
+        followed by one ``messages_sent`` with all of them.
+        """
+        now = timezone.now()
+        recipients = list(recipients)
+        messages = [
+            self.model(sender=sender, recipient=recipient, subject=subject,
+                       body=body, sent_at=now)
+            for recipient in recipients
+        ]
+        if not messages:
+            return []
+        if parent_msg is not None:
+            for message in messages:
+                message.set_parent(parent_msg)
+        with transaction.atomic(using=self.db):
+            self.bulk_create(messages)
+            if messages[0].pk is None:
+                # The backend doesn't return the ids of bulk inserted rows,
+                # read them back by their ``sent_at``. Filtering by the
+                # recipients could exceed the variable limit of SQLite.
+                by_recipient = dict((r.pk, r) for r in recipients)
+                messages = [
+                    message for message in self.filter(
+                        sender=sender, sent_at=now, parent_msg=parent_msg,
+                    ).order_by('id')
+                    if message.recipient_id in by_recipient]
+                for message in messages:
+                    message.sender = sender
+                    message.recipient = by_recipient[message.recipient_id]
+            if counters_enabled():
+                MailboxCounters.objects.apply(
+                    _state_deltas({}, _combined_state(messages)))
+            if parent_msg is not None:
+                self.mark_replied(parent_msg, now)
+            if email_queue_enabled():
+                # queued at once here instead of by ``queue_message_email``
+                QueuedEmail.objects.bulk_create([
+                    QueuedEmail(message=message) for message in messages])
+                for message in messages:
+                    message._email_queued = True
+        for message in messages:
+            message._loaded_mailbox_state = message.mailbox_state()
+        bump_mailbox_versions([sender.pk] + [r.pk for r in recipients])
+        for message in messages:
+            signals.post_save.send(
+                sender=self.model, instance=message, created=True,
+                update_fields=None, raw=False, using=self.db)
+        self._notify(messages_sent, messages, sender)
+        return messages
+
 
 @python_2_unicode_compatible
 class Message(models.Model):
@@ -63,9 +458,31 @@ class Message(models.Model):
     replied_at = models.DateTimeField(_("replied at"), null=True, blank=True)
     sender_deleted_at = models.DateTimeField(_("Sender deleted at"), null=True, blank=True)
     recipient_deleted_at = models.DateTimeField(_("Recipient deleted at"), null=True, blank=True)
+    thread_root = models.PositiveIntegerField(_("thread root"), null=True, blank=True, editable=False, help_text=_("The id of the first message of the conversation, empty for the first message itself."))
+    depth = models.PositiveIntegerField(_("depth"), default=0, editable=False)
 
     objects = MessageManager()
 
+    is_broadcast = False
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Message, cls).from_db(db, field_names, values)
+        # Remember the loaded state to update the counters on save. Without
+        # it (e.g. deferred fields) ``save`` recounts the involved users.
+        if counters_enabled() and set(MAILBOX_STATE_FIELDS) <= set(field_names):
+            instance._loaded_mailbox_state = instance.mailbox_state()
+        return instance
+
+    def mailbox_state(self):
+        """
+        Returns how this message contributes to the mailbox counters of its
+        sender and recipient.
+        """
+        return _mailbox_state(
+            self.sender_id, self.recipient_id, self.read_at,
+            self.sender_deleted_at, self.recipient_deleted_at)
+
     def new(self):
         """returns whether the recipient has read the message or not"""
         if self.read_at is not None:
@@ -84,25 +501,604 @@ class Message(models.Model):
     def get_absolute_url(self):
         return reverse('messages_detail', args=[self.id])
 
+    def set_parent(self, parent_msg):
+        """
+        Makes this message a reply to ``parent_msg`` within its thread.
+        """
+        self.parent_msg = parent_msg
+        self.thread_root = parent_msg.thread_root or parent_msg.pk
+        self.depth = parent_msg.depth + 1
+
     def save(self, **kwargs):
         if not self.id:
             self.sent_at = timezone.now()
-        super(Message, self).save(**kwargs)
+            if self.parent_msg_id is not None and self.thread_root is None:
+                self.set_parent(self.parent_msg)
+            before = {}
+        else:
+            before = getattr(self, '_loaded_mailbox_state', None)
+        if not counters_enabled():
+            super(Message, self).save(**kwargs)
+            after = self.mailbox_state()
+        else:
+            with transaction.atomic():
+                super(Message, self).save(**kwargs)
+                after = self.mailbox_state()
+                if before is None:
+                    # the previous state is unknown, recount the involved users
+                    MailboxCounters.objects.rebuild(user_ids=list(after))
+                else:
+                    MailboxCounters.objects.apply(_state_deltas(before, after))
+        self._loaded_mailbox_state = after
+        bump_mailbox_versions(list(after) + list(before or {}))
+
+    def delete(self, **kwargs):
+        user_ids = [self.sender_id, self.recipient_id]
+        if not counters_enabled():
+            result = super(Message, self).delete(**kwargs)
+        else:
+            with transaction.atomic():
+                deltas = _state_deltas(self.mailbox_state(), {})
+                result = super(Message, self).delete(**kwargs)
+                MailboxCounters.objects.apply(deltas)
+        bump_mailbox_versions(user_ids)
+        return result
 
     class Meta:
-        ordering = ['-sent_at']
+        ordering = ['-sent_at', '-id']
         verbose_name = _("Message")
         verbose_name_plural = _("Messages")
+        # One index per mailbox query of the ``MessageManager``. The
+        # conditions turn them into partial indexes on backends which
+        # support them; elsewhere the migrations create one plain index per
+        # role instead (see ``django_messages.operations``).
+        indexes = [
+            models.Index(
+                fields=['recipient', '-sent_at', '-id'],
+                name='messages_inbox_idx',
+                condition=models.Q(recipient_deleted_at__isnull=True),
+            ),
+            models.Index(
+                fields=['recipient', '-sent_at', '-id'],
+                name='messages_unread_idx',
+                condition=models.Q(read_at__isnull=True,
+                                   recipient_deleted_at__isnull=True),
+            ),
+            models.Index(
+                fields=['sender', '-sent_at', '-id'],
+                name='messages_outbox_idx',
+                condition=models.Q(sender_deleted_at__isnull=True),
+            ),
+            models.Index(
+                fields=['thread_root', 'sent_at'],
+                name='messages_thread_idx',
+            ),
+            models.Index(
+                fields=['recipient', '-sent_at', '-id'],
+                name='messages_trash_received_idx',
+                condition=models.Q(recipient_deleted_at__isnull=False),
+            ),
+            models.Index(
+                fields=['sender', '-sent_at', '-id'],
+                name='messages_trash_sent_idx',
+                condition=models.Q(sender_deleted_at__isnull=False),
+            ),
+        ]
+
+
+class MailboxCountersManager(models.Manager):
+
+    def counts_for(self, user):
+        """
+        Returns the ``MailboxCounters`` of the given user. Missing rows are
+        calculated from the messages table and stored.
+        """
+        try:
+            return self.get(pk=user.pk)
+        except self.model.DoesNotExist:
+            self.rebuild(user_ids=[user.pk])
+            return self.get(pk=user.pk)
+
+    def apply(self, deltas):
+        """
+        Atomically adds the given ``{user_id: {field: delta}}`` changes to the
+        stored counters, with one UPDATE per distinct change (e.g. all
+        recipients of a message share one). Users without a counters row
+        are recounted.
+        """
+        groups = {}
+        for user_id, delta in deltas.items():
+            key = tuple(sorted(
+                (field, value) for field, value in delta.items() if value))
+            if key:
+                groups.setdefault(key, []).append(user_id)
+        missing = []
+        for key, user_ids in groups.items():
+            changes = dict((field, F(field) + value) for field, value in key)
+            if self.filter(pk__in=user_ids).update(**changes) < len(user_ids):
+                existing = set(self.filter(pk__in=user_ids).values_list(
+                    'pk', flat=True))
+                missing.extend(user_id for user_id in user_ids
+                               if user_id not in existing)
+        if missing:
+            self.rebuild(user_ids=missing)
+
+    def rebuild(self, user_ids):
+        """
+        Recalculates the counters of the given users from the messages table.
+        """
+        user_ids = list(user_ids)
+        counts = dict(
+            (user_id, dict((field, 0) for field in COUNTER_FIELDS))
+            for user_id in user_ids)
+        messages = Message.objects.order_by()
+        for user_id, values in _aggregate_counts(messages, user_ids):
+            for field, value in values.items():
+                counts[user_id][field] += value
+        existing = set(self.filter(pk__in=user_ids).values_list(
+            'pk', flat=True))
+        for user_id in existing:
+            self.filter(pk=user_id).update(**counts[user_id])
+        # rows created concurrently are just as fresh
+        self.bulk_create([
+            self.model(user_id=user_id, **values)
+            for user_id, values in counts.items() if user_id not in existing
+        ], ignore_conflicts=True)
+
+    def discount(self, messages):
+        """
+        Subtracts the messages of the given queryset from the counters of
+        their senders and recipients. Call this within the transaction which
+        deletes the messages.
+        """
+        messages = messages.order_by()
+        deltas = {}
+        for user_id, values in _aggregate_counts(
+                messages, participant_ids(messages)):
+            delta = deltas.setdefault(user_id, {})
+            for field, value in values.items():
+                delta[field] = delta.get(field, 0) - value
+        self.apply(deltas)
+
+
+def _aggregate_counts(messages, user_ids):
+    """
+    Yields ``(user_id, {field: n})`` pairs with the number of messages in
+    each mailbox folder of the given users.
+    """
+    received = messages.filter(recipient__in=user_ids).values('recipient')
+    for row in received.annotate(
+            unread=Count('id', filter=Q(read_at__isnull=True,
+                                        recipient_deleted_at__isnull=True)),
+            inbox=Count('id', filter=Q(recipient_deleted_at__isnull=True)),
+            trash=Count('id', filter=Q(recipient_deleted_at__isnull=False))):
+        yield row['recipient'], {
+            'unread': row['unread'],
+            'inbox': row['inbox'],
+            'trash': row['trash'],
+        }
+    sent = messages.filter(sender__in=user_ids).values('sender')
+    for row in sent.annotate(
+            outbox=Count('id', filter=Q(sender_deleted_at__isnull=True)),
+            trash=Count('id', filter=Q(sender_deleted_at__isnull=False)),
+            # messages to oneself are in the trash only once
+            both=Count('id', filter=Q(recipient=F('sender'),
+                                      sender_deleted_at__isnull=False,
+                                      recipient_deleted_at__isnull=False))):
+        yield row['sender'], {
+            'outbox': row['outbox'],
+            'trash': row['trash'] - row['both'],
+        }
+
+
+def participant_ids(messages):
+    """
+    Returns the ids of all senders and recipients of the given messages.
+    """
+    messages = messages.order_by()
+    user_ids = set(messages.values_list('sender', flat=True).distinct())
+    user_ids.update(messages.filter(recipient__isnull=False).values_list(
+        'recipient', flat=True).distinct())
+    return user_ids
+
+
+class MailboxCounters(models.Model):
+    """
+    Denormalized per-user message counts, maintained on every change of a
+    message if ``DJANGO_MESSAGES_COUNTERS`` is enabled.
+    """
+    user = models.OneToOneField(AUTH_USER_MODEL, primary_key=True, related_name='mailbox_counters', verbose_name=_("User"), on_delete=models.CASCADE)
+    unread = models.IntegerField(_("unread messages"), default=0)
+    inbox = models.IntegerField(_("messages in inbox"), default=0)
+    outbox = models.IntegerField(_("messages in outbox"), default=0)
+    trash = models.IntegerField(_("messages in trash"), default=0)
+
+    objects = MailboxCountersManager()
+
+    class Meta:
+        verbose_name = _("Mailbox counters")
+        verbose_name_plural = _("Mailbox counters")
 
 
+@python_2_unicode_compatible
+class BroadcastJob(models.Model):
+    """
+    A message which is sent to all users or the users of a group in chunks,
+    outside of the request which created it. ``last_user_pk`` records the
+    progress, so an interrupted job continues where it stopped.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    STATUS_CHOICES = (
+        (PENDING, _("pending")),
+        (RUNNING, _("running")),
+        (DONE, _("done")),
+    )
+
+    sender = models.ForeignKey(AUTH_USER_MODEL, related_name='+', verbose_name=_("Sender"), on_delete=models.CASCADE)
+    group = models.ForeignKey('auth.Group', null=True, blank=True, related_name='+', verbose_name=_("group"), help_text=_("Leave empty to send the message to all users."), on_delete=models.CASCADE)
+    exclude_user = models.ForeignKey(AUTH_USER_MODEL, null=True, blank=True, related_name='+', verbose_name=_("excluded user"), on_delete=models.SET_NULL)
+    parent_msg = models.ForeignKey(Message, null=True, blank=True, related_name='+', verbose_name=_("Parent message"), on_delete=models.SET_NULL)
+    subject = models.CharField(_("Subject"), max_length=140)
+    body = models.TextField(_("Body"))
+    status = models.CharField(_("status"), max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    created_at = models.DateTimeField(_("created at"), default=timezone.now)
+    finished_at = models.DateTimeField(_("finished at"), null=True, blank=True)
+    last_user_pk = models.CharField(_("last recipient"), max_length=255, blank=True, editable=False)
+    sent_count = models.PositiveIntegerField(_("sent messages"), default=0)
+    total = models.PositiveIntegerField(_("recipients"), null=True, blank=True)
+
+    def __str__(self):
+        return self.subject
+
+    class Meta:
+        ordering = ['created_at']
+        verbose_name = _("Broadcast")
+        verbose_name_plural = _("Broadcasts")
+
+
+class BroadcastManager(models.Manager):
+
+    def visible_to(self, user):
+        """
+        Returns all broadcasts addressed to the given user, i.e. to all users
+        or one of the user's groups, sent since the user joined.
+        """
+        broadcasts = self.filter(
+            Q(group__isnull=True) | Q(group__in=user.groups.all()))
+        date_joined = getattr(user, 'date_joined', None)
+        if date_joined is not None:
+            broadcasts = broadcasts.filter(sent_at__gte=date_joined)
+        return broadcasts
+
+    def inbox_for(self, user):
+        """
+        Returns all broadcasts in the inbox of the given user. Each broadcast
+        is annotated with the user's ``read_at``.
+        """
+        states = BroadcastState.objects.filter(user=user)
+        return self.visible_to(user).exclude(
+            pk__in=states.filter(deleted_at__isnull=False).values('broadcast'),
+        ).annotate(
+            read_at=Subquery(states.filter(
+                broadcast=OuterRef('pk')).values('read_at')[:1]),
+        )
+
+    def unread_for(self, user):
+        """
+        Returns all broadcasts in the inbox of the given user which have not
+        been read yet.
+        """
+        seen = BroadcastState.objects.filter(user=user).filter(
+            Q(read_at__isnull=False) | Q(deleted_at__isnull=False))
+        return self.visible_to(user).exclude(
+            pk__in=seen.values('broadcast'))
+
+    def _set_state(self, broadcast, user, **values):
+        """
+        Sets the given fields of the user's state of the broadcast, creating
+        the state row on first use.
+        """
+        state, created = BroadcastState.objects.get_or_create(
+            broadcast=broadcast, user=user, defaults=values)
+        if not created:
+            BroadcastState.objects.filter(pk=state.pk).update(**values)
+        bump_mailbox_versions([user.pk])
+
+    def mark_read(self, broadcast, user):
+        self._set_state(broadcast, user, read_at=timezone.now())
+
+    def mark_deleted(self, broadcast, user):
+        self._set_state(broadcast, user, deleted_at=timezone.now())
+
+
+@python_2_unicode_compatible
+class Broadcast(models.Model):
+    """
+    A message to all users or a group of users. The content is stored only
+    once; whether a user has read or deleted it is stored in a
+    ``BroadcastState`` row, which is created when the user does so.
+    """
+    sender = models.ForeignKey(AUTH_USER_MODEL, related_name='+', verbose_name=_("Sender"), on_delete=models.PROTECT)
+    group = models.ForeignKey('auth.Group', null=True, blank=True, related_name='+', verbose_name=_("group"), help_text=_("Leave empty to send the message to all users."), on_delete=models.CASCADE)
+    subject = models.CharField(_("Subject"), max_length=140)
+    body = models.TextField(_("Body"))
+    sent_at = models.DateTimeField(_("sent at"), default=timezone.now)
+
+    objects = BroadcastManager()
+
+    is_broadcast = True
+    recipient = None
+    replied_at = None
+
+    def new(self):
+        """returns whether the user has read the broadcast or not, only
+        available on broadcasts of ``Broadcast.objects.inbox_for``"""
+        return getattr(self, 'read_at', None) is None
+
+    def replied(self):
+        return False
+
+    def __str__(self):
+        return self.subject
+
+    def get_absolute_url(self):
+        return reverse('messages_broadcast_detail', args=[self.id])
+
+    class Meta:
+        ordering = ['-sent_at', '-id']
+        verbose_name = _("Broadcast message")
+        verbose_name_plural = _("Broadcast messages")
+        indexes = [
+            models.Index(fields=['-sent_at', '-id'],
+                         name='messages_broadcast_idx'),
+        ]
+
+
+class BroadcastState(models.Model):
+    """
+    Whether a user has read or deleted a ``Broadcast``.
+    """
+    broadcast = models.ForeignKey(Broadcast, related_name='states', verbose_name=_("Broadcast message"), on_delete=models.CASCADE)
+    user = models.ForeignKey(AUTH_USER_MODEL, related_name='+', verbose_name=_("User"), on_delete=models.CASCADE)
+    read_at = models.DateTimeField(_("read at"), null=True, blank=True)
+    deleted_at = models.DateTimeField(_("deleted at"), null=True, blank=True)
+
+    class Meta:
+        unique_together = (('user', 'broadcast'),)
+        verbose_name = _("Broadcast state")
+        verbose_name_plural = _("Broadcast states")
+
+
+class QueuedEmail(models.Model):
+    """
+    A pending email notification about a new message, sent by the
+    ``send_queued_emails`` command if ``DJANGO_MESSAGES_EMAIL_QUEUE`` is
+    enabled.
+    """
+    message = models.ForeignKey(Message, related_name='+', verbose_name=_("Message"), on_delete=models.CASCADE)
+    created_at = models.DateTimeField(_("created at"), default=timezone.now)
+    next_attempt_at = models.DateTimeField(_("next attempt at"), default=timezone.now, db_index=True)
+    attempts = models.PositiveIntegerField(_("attempts"), default=0)
+    last_error = models.TextField(_("last error"), blank=True)
+    failed_at = models.DateTimeField(_("failed at"), null=True, blank=True)
+
+    class Meta:
+        ordering = ['next_attempt_at', 'id']
+        verbose_name = _("Queued email")
+        verbose_name_plural = _("Queued emails")
+
+
+class ArchivedMessageManager(models.Manager):
+
+    def inbox_for(self, user):
+        """
+        Returns all archived messages that were received by the given user
+        and are not marked as deleted.
+        """
+        return self.filter(
+            recipient=user,
+            recipient_deleted_at__isnull=True,
+        )
+
+    def outbox_for(self, user):
+        """
+        Returns all archived messages that were sent by the given user and
+        are not marked as deleted.
+        """
+        return self.filter(
+            sender=user,
+            sender_deleted_at__isnull=True,
+        )
+
+    def thread_for(self, user, message):
+        """
+        Returns all archived messages of the conversation ``message`` (an
+        archived message or its id) belongs to, which were sent or received
+        by the given user, in chronological order.
+        """
+        message_id = getattr(message, 'pk', message)
+        root = self.filter(pk=message_id).annotate(
+            root=Coalesce('thread_root', 'id',
+                          output_field=models.IntegerField())).values('root')
+        return self.filter(
+            Q(thread_root=Subquery(root)) | Q(pk=Subquery(root)),
+            Q(sender=user) | Q(recipient=user),
+        ).order_by('sent_at', 'id')
+
+    @instrumented('messages.archive', rows=int)
+    def archive(self, messages):
+        """
+        Moves the given messages (a queryset of ``Message``) into the archive
+        in one transaction, keeping their ids. Returns the number of archived
+        messages.
+        """
+        user_ids = participant_ids(messages)
+        with transaction.atomic(using=self.db):
+            message_list = list(messages.order_by())
+            ids = [message.pk for message in message_list]
+            self.bulk_create([
+                self.model(
+                    id=message.pk,
+                    subject=message.subject,
+                    body=message.body,
+                    sender_id=message.sender_id,
+                    recipient_id=message.recipient_id,
+                    parent_id=message.parent_msg_id,
+                    sent_at=message.sent_at,
+                    read_at=message.read_at,
+                    replied_at=message.replied_at,
+                    sender_deleted_at=message.sender_deleted_at,
+                    recipient_deleted_at=message.recipient_deleted_at,
+                    thread_root=message.thread_root,
+                    depth=message.depth,
+                ) for message in message_list])
+            archived = Message.objects.filter(pk__in=ids)
+            if counters_enabled():
+                MailboxCounters.objects.discount(archived)
+            archived.delete()
+        bump_mailbox_versions(user_ids)
+        return len(ids)
+
+
+@python_2_unicode_compatible
+class ArchivedMessage(models.Model):
+    """
+    A message moved out of the ``Message`` table by the ``archive_messages``
+    command. It keeps the id of the original message; ``parent_id`` and
+    ``thread_root`` refer to other archived messages.
+    """
+    id = models.IntegerField(primary_key=True)
+    subject = models.CharField(_("Subject"), max_length=140)
+    body = models.TextField(_("Body"))
+    sender = models.ForeignKey(AUTH_USER_MODEL, related_name='+', verbose_name=_("Sender"), on_delete=models.PROTECT)
+    recipient = models.ForeignKey(AUTH_USER_MODEL, related_name='+', null=True, blank=True, verbose_name=_("Recipient"), on_delete=models.SET_NULL)
+    parent_id = models.PositiveIntegerField(_("Parent message"), null=True, blank=True)
+    sent_at = models.DateTimeField(_("sent at"), null=True, blank=True)
+    read_at = models.DateTimeField(_("read at"), null=True, blank=True)
+    replied_at = models.DateTimeField(_("replied at"), null=True, blank=True)
+    sender_deleted_at = models.DateTimeField(_("Sender deleted at"), null=True, blank=True)
+    recipient_deleted_at = models.DateTimeField(_("Recipient deleted at"), null=True, blank=True)
+    thread_root = models.PositiveIntegerField(_("thread root"), null=True, blank=True)
+    depth = models.PositiveIntegerField(_("depth"), default=0)
+    archived_at = models.DateTimeField(_("archived at"), default=timezone.now)
+
+    objects = ArchivedMessageManager()
+
+    is_broadcast = False
+
+    def new(self):
+        """returns whether the recipient has read the message or not"""
+        return self.read_at is None
+
+    def replied(self):
+        """returns whether the recipient has written a reply to this message"""
+        return self.replied_at is not None
+
+    def __str__(self):
+        return self.subject
+
+    def get_absolute_url(self):
+        return reverse('messages_archive_detail', args=[self.id])
+
+    class Meta:
+        ordering = ['-sent_at', '-id']
+        verbose_name = _("Archived message")
+        verbose_name_plural = _("Archived messages")
+        indexes = [
+            models.Index(
+                fields=['recipient', '-sent_at', '-id'],
+                name='messages_archive_inbox_idx',
+            ),
+            models.Index(
+                fields=['sender', '-sent_at', '-id'],
+                name='messages_archive_outbox_idx',
+            ),
+            models.Index(
+                fields=['thread_root', 'sent_at'],
+                name='messages_archive_thread_idx',
+            ),
+        ]
+
+
+def _unread_messages_for(user):
+    """
+    Returns the number of unread messages of the given user and whether any
+    broadcasts exist, with a single query, so the costly broadcast count can
+    be skipped while there are none.
+    """
+    if counters_enabled():
+        unread = MailboxCounters.objects.filter(pk=user.pk).values('unread')
+    else:
+        unread = Message.objects.unread_for(user).order_by().values(
+            'recipient').annotate(count=Count('id')).values('count')
+    row = user._meta.model._default_manager.filter(pk=user.pk).annotate(
+        unread=Subquery(unread, output_field=models.IntegerField()),
+        broadcasts_exist=Exists(Broadcast.objects.all()),
+    ).values_list('unread', 'broadcasts_exist').first()
+    if row is None:
+        return 0, False
+    unread, broadcasts_exist = row
+    if unread is None:
+        if counters_enabled():
+            # no counters row yet
+            unread = MailboxCounters.objects.counts_for(user).unread
+        else:
+            unread = 0
+    return unread, broadcasts_exist
+
+
+@instrumented('messages.inbox_count_for')
 def inbox_count_for(user):
     """
     returns the number of unread messages for the given user but does not
     mark them seen
     """
-    return Message.objects.filter(recipient=user, read_at__isnull=True, recipient_deleted_at__isnull=True).count()
+    def count():
+        unread, broadcasts_exist = _unread_messages_for(user)
+        if broadcasts_exist:
+            unread += Broadcast.objects.unread_for(user).count()
+        return unread
+    return cached_for(user.pk, 'unread', count)
+
+
+def bump_broadcasts(sender, **kwargs):
+    """
+    Invalidates the cached values of all users when a broadcast is saved or
+    deleted, also by a bulk delete. Connected to ``post_save`` and
+    ``post_delete`` of ``Broadcast``.
+    """
+    if not kwargs.get('raw'):
+        bump_mailbox_versions([SHARED])
+
+
+def bump_group_members(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Invalidates the cached values of users who joined or left a group, as
+    the broadcasts addressed to them changed. Connected to ``m2m_changed``
+    of the user's groups.
+    """
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        bump_mailbox_versions([instance.pk])
+    elif pk_set is None:
+        # the former members of a cleared group are unknown
+        bump_mailbox_versions([SHARED])
+    else:
+        bump_mailbox_versions(pk_set)
+
+
+signals.post_save.connect(publish_new_message, sender=Message)
+signals.post_save.connect(bump_broadcasts, sender=Broadcast)
+signals.post_delete.connect(bump_broadcasts, sender=Broadcast)
 
 # fallback for email notification if django-notification could not be found
 if "pinax.notifications" not in settings.INSTALLED_APPS and getattr(settings, 'DJANGO_MESSAGES_NOTIFY', True):
-    from django_messages.utils import new_message_email
-    signals.post_save.connect(new_message_email, sender=Message)
+    if email_queue_enabled():
+        from django_messages.email_queue import queue_message_email
+        signals.post_save.connect(queue_message_email, sender=Message)
+    else:
+        from django_messages.utils import new_message_email
+        signals.post_save.connect(new_message_email, sender=Message)
@@ -0,0 +1,92 @@
+"""
+Migration operations for the partial indexes of the mailbox queries.
+
+Backends without partial indexes (e.g. MySQL) would create every partial
+index as a plain index, which leaves several identical indexes to update
+on every write. There these operations maintain a single plain index per
+set of fields instead, shared by all partial indexes on those fields.
+"""
+from django.db import migrations, models
+
+
+def _fallback_index(model, index):
+    fallback = models.Index(fields=index.fields)
+    fallback.set_name_with_model(model)
+    return fallback
+
+
+def _has_partial_index(state, app_label, model_name, fields):
+    model_state = state.models[app_label, model_name]
+    return any(index.condition is not None and index.fields == fields
+               for index in model_state.options['indexes'])
+
+
+class PartialIndexMixin(object):
+
+    def _partial_supported(self, schema_editor):
+        return schema_editor.connection.features.supports_partial_indexes
+
+    def _add_fallback(self, app_label, schema_editor, state_without,
+                      state_with, index):
+        model = state_with.apps.get_model(app_label, self.model_name)
+        if (self.allow_migrate_model(schema_editor.connection.alias, model) and
+                not _has_partial_index(state_without, app_label,
+                                       self.model_name_lower, index.fields)):
+            schema_editor.add_index(model, _fallback_index(model, index))
+
+    def _remove_fallback(self, app_label, schema_editor, state_with,
+                         state_without, index):
+        model = state_with.apps.get_model(app_label, self.model_name)
+        if (self.allow_migrate_model(schema_editor.connection.alias, model) and
+                not _has_partial_index(state_without, app_label,
+                                       self.model_name_lower, index.fields)):
+            schema_editor.remove_index(model, _fallback_index(model, index))
+
+
+class AddPartialIndex(PartialIndexMixin, migrations.AddIndex):
+    """
+    Adds an index with a condition, or the shared plain index on its fields
+    if the backend lacks partial indexes.
+    """
+
+    def database_forwards(self, app_label, schema_editor, from_state,
+                          to_state):
+        if self._partial_supported(schema_editor):
+            return super(AddPartialIndex, self).database_forwards(
+                app_label, schema_editor, from_state, to_state)
+        self._add_fallback(app_label, schema_editor, from_state, to_state,
+                           self.index)
+
+    def database_backwards(self, app_label, schema_editor, from_state,
+                           to_state):
+        if self._partial_supported(schema_editor):
+            return super(AddPartialIndex, self).database_backwards(
+                app_label, schema_editor, from_state, to_state)
+        self._remove_fallback(app_label, schema_editor, from_state, to_state,
+                              self.index)
+
+
+class RemovePartialIndex(PartialIndexMixin, migrations.RemoveIndex):
+    """
+    Removes an index added with ``AddPartialIndex``.
+    """
+
+    def _index(self, state, app_label):
+        model_state = state.models[app_label, self.model_name_lower]
+        return model_state.get_index_by_name(self.name)
+
+    def database_forwards(self, app_label, schema_editor, from_state,
+                          to_state):
+        if self._partial_supported(schema_editor):
+            return super(RemovePartialIndex, self).database_forwards(
+                app_label, schema_editor, from_state, to_state)
+        self._remove_fallback(app_label, schema_editor, from_state, to_state,
+                              self._index(from_state, app_label))
+
+    def database_backwards(self, app_label, schema_editor, from_state,
+                           to_state):
+        if self._partial_supported(schema_editor):
+            return super(RemovePartialIndex, self).database_backwards(
+                app_label, schema_editor, from_state, to_state)
+        self._add_fallback(app_label, schema_editor, from_state, to_state,
+                           self._index(to_state, app_label))
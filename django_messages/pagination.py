@@ -0,0 +1,134 @@
+"""
+Keyset pagination for the message folders.
+
+Pages are addressed by opaque cursors which encode the ``(sent_at, id)`` key
+of the first or last message of the neighbouring page. Each page is fetched
+with an index range scan, so deep pages cost the same as the first one.
+"""
+import base64
+import binascii
+
+from django.conf import settings
+from django.utils.dateparse import parse_datetime
+from django.utils.encoding import force_bytes, force_text
+
+DEFAULT_PAGE_SIZE = 50
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def get_page_size():
+    return getattr(settings, 'DJANGO_MESSAGES_PAGE_SIZE', DEFAULT_PAGE_SIZE)
+
+
+def encode_cursor(direction, message):
+    value = '%s|%s|%s' % (direction, message.sent_at.isoformat(), message.pk)
+    return force_text(base64.urlsafe_b64encode(force_bytes(value))).rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Returns the ``(direction, sent_at, id)`` tuple encoded in ``cursor``.
+    """
+    try:
+        cursor = force_bytes(cursor)
+        value = force_text(base64.urlsafe_b64decode(
+            cursor + b'=' * (-len(cursor) % 4)))
+        direction, sent_at, pk = value.split('|')
+        sent_at = parse_datetime(sent_at)
+        pk = int(pk)
+    except (TypeError, ValueError, binascii.Error, UnicodeDecodeError):
+        raise InvalidCursor(cursor)
+    if direction not in ('n', 'p') or sent_at is None:
+        raise InvalidCursor(cursor)
+    return direction, sent_at, pk
+
+
+class CursorPage(object):
+    """
+    A page of messages with the cursors of its neighbouring pages.
+    """
+    def __init__(self, object_list, has_next, has_previous):
+        self.object_list = object_list
+        self.has_next = has_next
+        self.has_previous = has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    @property
+    def next_cursor(self):
+        if self.has_next and self.object_list:
+            return encode_cursor('n', self.object_list[-1])
+        return None
+
+    @property
+    def previous_cursor(self):
+        if self.has_previous and self.object_list:
+            return encode_cursor('p', self.object_list[0])
+        return None
+
+
+def _fetch(querysets, limit, cursor):
+    """
+    Returns up to ``limit`` messages of all ``querysets`` following the
+    cursor key, in the order of the cursor's direction. Each queryset is
+    limited separately (so it can be served by its own index) and the
+    results are merged.
+    """
+    direction, sent_at, pk = cursor or ('n', None, None)
+    descending = direction == 'n'
+    messages = {}
+    for queryset in querysets:
+        queryset = queryset.filter(sent_at__isnull=False)
+        if sent_at is not None and descending:
+            queryset = queryset.filter(sent_at__lte=sent_at).exclude(
+                sent_at=sent_at, id__gte=pk)
+        elif sent_at is not None:
+            queryset = queryset.filter(sent_at__gte=sent_at).exclude(
+                sent_at=sent_at, id__lte=pk)
+        if descending:
+            queryset = queryset.order_by('-sent_at', '-id')
+        else:
+            queryset = queryset.order_by('sent_at', 'id')
+        for message in queryset[:limit]:
+            # querysets may list the same message or different models
+            messages[(message._meta.label, message.pk)] = message
+    messages = sorted(messages.values(), key=lambda m: (m.sent_at, m.pk),
+                      reverse=descending)
+    return messages[:limit]
+
+
+def paginate(querysets, cursor=None, per_page=None):
+    """
+    Returns the ``CursorPage`` addressed by ``cursor`` (the first page if
+    ``cursor`` is empty). ``querysets`` is either a queryset or a list of
+    querysets whose messages are merged into one folder, e.g. the two halves
+    of the trash or the messages and broadcasts of the inbox. Raises
+    ``InvalidCursor`` for cursors which were not created by this module.
+    Messages without ``sent_at`` are not paginated.
+    """
+    if per_page is None:
+        per_page = get_page_size()
+    if not isinstance(querysets, (list, tuple)):
+        querysets = [querysets]
+    if not cursor:
+        messages = _fetch(querysets, per_page + 1, None)
+        return CursorPage(messages[:per_page], len(messages) > per_page, False)
+
+    cursor = decode_cursor(cursor)
+    messages = _fetch(querysets, per_page + 1, cursor)
+    if cursor[0] == 'n':
+        return CursorPage(messages[:per_page], len(messages) > per_page, True)
+    has_previous = len(messages) > per_page
+    messages = messages[:per_page]
+    messages.reverse()
+    return CursorPage(messages, True, has_previous)
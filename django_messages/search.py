@@ -0,0 +1,141 @@
+"""
+Full-text search over the messages of a mailbox.
+
+The backend is chosen by the database vendor: SQLite uses the FTS5 table
+``django_messages_message_fts`` and PostgreSQL a GIN index on the message's
+``tsvector``, both created by the migrations and kept in sync by the
+database itself. Other databases fall back to ``icontains`` lookups. Set
+``DJANGO_MESSAGES_SEARCH_BACKEND`` to the dotted path of a backend class to
+use a different one.
+"""
+from django.conf import settings
+from django.db import connections
+from django.db.models import Q
+from django.utils.module_loading import import_string
+
+FTS_TABLE = 'django_messages_message_fts'
+
+# SQLite rebuilds a table on most schema changes, which drops its triggers.
+# ``restore_sqlite_triggers`` recreates them after every ``migrate``.
+SQLITE_TRIGGERS = {
+    'django_messages_message_fts_insert':
+        "CREATE TRIGGER django_messages_message_fts_insert "
+        "AFTER INSERT ON django_messages_message BEGIN "
+        "INSERT INTO django_messages_message_fts(rowid, subject, body) "
+        "VALUES (new.id, new.subject, new.body); END",
+    'django_messages_message_fts_delete':
+        "CREATE TRIGGER django_messages_message_fts_delete "
+        "AFTER DELETE ON django_messages_message BEGIN "
+        "INSERT INTO django_messages_message_fts"
+        "(django_messages_message_fts, rowid, subject, body) "
+        "VALUES ('delete', old.id, old.subject, old.body); END",
+    'django_messages_message_fts_update':
+        "CREATE TRIGGER django_messages_message_fts_update "
+        "AFTER UPDATE OF subject, body ON django_messages_message BEGIN "
+        "INSERT INTO django_messages_message_fts"
+        "(django_messages_message_fts, rowid, subject, body) "
+        "VALUES ('delete', old.id, old.subject, old.body); "
+        "INSERT INTO django_messages_message_fts(rowid, subject, body) "
+        "VALUES (new.id, new.subject, new.body); END",
+}
+
+SQLITE_REBUILD = (
+    "INSERT INTO django_messages_message_fts(django_messages_message_fts) "
+    "VALUES ('rebuild')")
+
+_fts_available = {}
+
+
+class SimpleSearchBackend(object):
+    """
+    Matches messages whose subject or body contains all words of the query.
+    Needs no index, but scans the whole mailbox.
+    """
+    def search(self, queryset, query):
+        for word in query.split():
+            queryset = queryset.filter(
+                Q(subject__icontains=word) | Q(body__icontains=word))
+        return queryset
+
+
+class SQLiteSearchBackend(SimpleSearchBackend):
+    """
+    Uses the FTS5 table, if the SQLite library supports it.
+    """
+    def search(self, queryset, query):
+        connection = connections[queryset.db]
+        key = (queryset.db, connection.settings_dict['NAME'])
+        if key not in _fts_available:
+            with connection.cursor() as cursor:
+                _fts_available[key] = FTS_TABLE in (
+                    connection.introspection.table_names(cursor))
+        if not _fts_available[key]:
+            return super(SQLiteSearchBackend, self).search(queryset, query)
+        # quote every word, so the query can't use the FTS5 syntax
+        match = ' '.join(
+            '"%s"' % word.replace('"', '""') for word in query.split())
+        # ``pk__in=RawSQL(...)`` would wrap the subquery in another pair of
+        # parentheses, which SQLite reads as a single value
+        return queryset.extra(
+            where=['"django_messages_message"."id" IN '
+                   '(SELECT rowid FROM %s WHERE %s MATCH %%s)'
+                   % (FTS_TABLE, FTS_TABLE)],
+            params=[match])
+
+
+class PostgresSearchBackend(object):
+    """
+    Uses the ``messages_search_idx`` GIN index. The expression must match
+    the one of the index for PostgreSQL to use it.
+    """
+    def search(self, queryset, query):
+        return queryset.extra(
+            where=["to_tsvector('simple', subject || ' ' || body) "
+                   "@@ plainto_tsquery('simple', %s)"],
+            params=[query])
+
+
+BACKENDS = {
+    'sqlite': SQLiteSearchBackend,
+    'postgresql': PostgresSearchBackend,
+}
+
+
+def restore_sqlite_triggers(using='default'):
+    """
+    Recreates the triggers which keep the SQLite full-text table in sync,
+    if a rebuild of the message table dropped them, and rebuilds the
+    full-text index. Returns whether any trigger was missing.
+    """
+    connection = connections[using]
+    if connection.vendor != 'sqlite':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE name IN (%s)" % ', '.join(
+                ['%s'] * (len(SQLITE_TRIGGERS) + 1)),
+            [FTS_TABLE] + sorted(SQLITE_TRIGGERS))
+        existing = set(row[0] for row in cursor.fetchall())
+        if FTS_TABLE not in existing:
+            return False
+        missing = sorted(set(SQLITE_TRIGGERS) - existing)
+        for name in missing:
+            cursor.execute(SQLITE_TRIGGERS[name])
+        if missing:
+            cursor.execute(SQLITE_REBUILD)
+    return bool(missing)
+
+
+def restore_search_index(sender, using='default', **kwargs):
+    """
+    Restores the SQLite search triggers after ``migrate``. Connected to
+    ``post_migrate``.
+    """
+    restore_sqlite_triggers(using)
+
+
+def get_search_backend(using='default'):
+    path = getattr(settings, 'DJANGO_MESSAGES_SEARCH_BACKEND', None)
+    if path:
+        return import_string(path)()
+    return BACKENDS.get(connections[using].vendor, SimpleSearchBackend)()
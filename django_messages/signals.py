@@ -0,0 +1,31 @@
+"""
+Signals sent once per user action with all messages it affected.
+
+Unlike ``post_save`` of ``Message``, which fires for every row and doesn't
+tell what changed, receivers of these signals can handle a whole compose or
+bulk action at once. They are sent with ``Message`` as sender, after the
+changes were written.
+
+``messages_sent``
+    New messages were sent. ``messages`` is the list of created messages,
+    ``user`` their sender. A broadcast sends it once per chunk.
+
+``messages_read``
+    ``user`` read the ``messages`` they received, by opening one of them or
+    with a bulk action.
+
+``messages_deleted``
+    ``user`` moved the ``messages`` to their trash.
+
+``messages_restored``
+    ``user`` recovered the ``messages`` from their trash.
+
+Only messages which actually changed are passed, and no signal is sent if
+none did.
+"""
+from django.dispatch import Signal
+
+messages_sent = Signal(providing_args=['messages', 'user'])
+messages_read = Signal(providing_args=['messages', 'user'])
+messages_deleted = Signal(providing_args=['messages', 'user'])
+messages_restored = Signal(providing_args=['messages', 'user'])
@@ -1,5 +1,9 @@
 from django.template import Library, Node, TemplateSyntaxError
 
+from django_messages.context_processors import request_inbox_count
+from django_messages.models import inbox_count_for
+from django_messages.utils import user_is_authenticated
+
 class InboxOutput(Node):
     def __init__(self, varname=None):
         self.varname = varname
@@ -7,7 +11,13 @@ class InboxOutput(Node):
     def render(self, context):
         try:
             user = context['user']
-            count = user.received_messages.filter(read_at__isnull=True, recipient_deleted_at__isnull=True).count()
+            request = context.get('request')
+            if not user_is_authenticated(user):
+                count = ''
+            elif getattr(request, 'user', None) == user:
+                count = request_inbox_count(request)
+            else:
+                count = inbox_count_for(user)
         except (KeyError, AttributeError):
             count = ''
         if self.varname is not None:
@@ -1,18 +1,48 @@
+import datetime
+import importlib
+import smtplib
+import threading
+import time
+from io import StringIO
+from unittest import skipUnless
+from unittest.mock import patch
+
 try:
     from django.core.urlresolvers import reverse
 except ImportError:
     from django.urls import reverse
 
+from django.apps import apps
+from django.core.cache import caches
+from django.core import mail
 from django.core.exceptions import ValidationError
-from django.test import TestCase
+from django.core.mail.backends.locmem import EmailBackend
+from django.core.management import call_command
+from django.db import connection
+from django.db import models
+from django.db.models import Q, signals
+from django.test.utils import CaptureQueriesContext
+from django.test import TestCase, TransactionTestCase, override_settings
 from django.test.client import Client, RequestFactory
 from django.utils import timezone
 from django.utils.encoding import force_text
-from django.contrib.auth.models import AnonymousUser
+from django.contrib.auth.models import AnonymousUser, Group
+from django.contrib.messages.storage.cookie import CookieStorage
 from django.template import Template, Context
+from django_messages.broadcast import run_broadcast, run_pending_broadcasts
+from django_messages import changes
+from django_messages.autocomplete import complete_usernames
+from django_messages.fields import RecipientFilter
+from django_messages.email_queue import queue_message_email, send_queued_emails
 from django_messages.forms import ComposeForm
-from django_messages.models import Message
-from django_messages.utils import format_subject, format_quote
+from django_messages.instrumentation import MemorySink, operation
+from django_messages.pagination import InvalidCursor, paginate
+from django_messages import search
+from django_messages.signals import (messages_deleted, messages_read,
+    messages_restored, messages_sent)
+from django_messages.models import (ArchivedMessage, Broadcast, BroadcastJob,
+    BroadcastState, MailboxCounters, Message, QueuedEmail, inbox_count_for)
+from django_messages.utils import format_subject, format_quote, new_message_email
 from django_messages.context_processors import inbox
 
 from .utils import get_user_model
@@ -240,6 +270,38 @@ class InboxCountTestCase(TestCase):
         html = self.template.render(Context({'user': self.user_2}))
         self.assertEquals(html, "1")
 
+    def test_context_processor_lazy(self):
+        """The count is only queried when it is used."""
+        r = self.factory.get('/')
+        r.user = self.user_2
+        with self.assertNumQueries(0):
+            context = inbox(r)
+        with self.assertNumQueries(1):
+            self.assertEqual("%s" % context['messages_inbox_count'], "1")
+
+    def test_context_processor_int(self):
+        """The lazy count behaves like the integer it stands for."""
+        r = self.factory.get('/')
+        r.user = self.user_2
+        context = inbox(r)
+        html = Template("{{ messages_inbox_count|add:1 }} "
+                        "{% if messages_inbox_count %}new{% endif %}").render(
+            Context(context))
+        self.assertEqual(html, "2 new")
+        self.assertEqual(int(context['messages_inbox_count']), 1)
+        self.assertEqual(context['messages_inbox_count'] + 1, 2)
+
+    def test_request_memoized(self):
+        """Processor and template tags share one query per request."""
+        r = self.factory.get('/')
+        r.user = self.user_2
+        template = Template("{% load inbox %}{{ messages_inbox_count }} "
+                            "{% inbox_count %} {% inbox_count as c %}{{ c }}")
+        with self.assertNumQueries(1):
+            html = template.render(Context(dict(
+                inbox(r), user=self.user_2, request=r)))
+        self.assertEqual(html, "1 1 1")
+
 
 class RecipientFilterTestCase(TestCase):
     def setUp(self):
@@ -274,3 +336,1462 @@ class RecipientFilterTestCase(TestCase):
         )
         assert not form.is_valid()
         assert self.user2.username in force_text(form.errors)
+
+
+@skipUnless(connection.vendor == 'sqlite', "EXPLAIN output is SQLite specific")
+class QueryPlanTestCase(TestCase):
+    """Make sure the mailbox queries are served by their indexes."""
+    def setUp(self):
+        self.user = User.objects.create_user(
+            'user1', 'user1@example.com', '123456')
+
+    def assertUsesIndex(self, queryset, index_name):
+        plan = queryset.explain()
+        self.assertIn('USING INDEX %s' % index_name, plan)
+        # the index order matches ``-sent_at``, so no extra sort step
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def testInbox(self):
+        self.assertUsesIndex(Message.objects.inbox_for(self.user),
+                             'messages_inbox_idx')
+
+    def testOutbox(self):
+        self.assertUsesIndex(Message.objects.outbox_for(self.user),
+                             'messages_outbox_idx')
+
+    def testUnread(self):
+        self.assertUsesIndex(Message.objects.unread_for(self.user),
+                             'messages_unread_idx')
+
+    def testTrash(self):
+        self.assertUsesIndex(Message.objects.trash_received_for(self.user),
+                             'messages_trash_received_idx')
+        self.assertUsesIndex(Message.objects.trash_sent_for(self.user),
+                             'messages_trash_sent_idx')
+
+    def testInboxPage(self):
+        msg = Message.objects.create(sender=self.user, recipient=self.user,
+                                     subject='S', body='B')
+        queryset = Message.objects.inbox_for(self.user).filter(
+            sent_at__lte=msg.sent_at).exclude(
+            sent_at=msg.sent_at, id__gte=msg.pk)
+        self.assertUsesIndex(queryset, 'messages_inbox_idx')
+
+
+@override_settings(DJANGO_MESSAGES_COUNTERS=True)
+class MailboxCountersTestCase(TestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(
+            'user1', 'user1@example.com', '123456')
+        self.user2 = User.objects.create_user(
+            'user2', 'user2@example.com', '123456')
+        self.c = Client()
+        self.c.login(username='user2', password='123456')
+
+    def assertCounters(self, user, **expected):
+        counters = MailboxCounters.objects.get(pk=user.pk)
+        actual = dict((field, getattr(counters, field)) for field in expected)
+        self.assertEqual(actual, expected)
+        self.assertEqual(counters.unread,
+                         Message.objects.unread_for(user).count())
+        self.assertEqual(counters.inbox,
+                         Message.objects.inbox_for(user).count())
+        self.assertEqual(counters.outbox,
+                         Message.objects.outbox_for(user).count())
+        self.assertEqual(counters.trash,
+                         Message.objects.trash_for(user).count())
+
+    def send(self, sender, recipients):
+        form = ComposeForm({
+            'recipient': ','.join(u.username for u in recipients),
+            'subject': 'S', 'body': 'B'})
+        self.assertTrue(form.is_valid())
+        return form.save(sender=sender)
+
+    def testLifecycle(self):
+        msg = self.send(self.user1, [self.user2])[0]
+        self.assertCounters(self.user1, outbox=1, inbox=0, unread=0)
+        self.assertCounters(self.user2, inbox=1, unread=1, outbox=0)
+        self.assertEqual(inbox_count_for(self.user2), 1)
+
+        self.c.get(reverse('messages_detail', args=[msg.pk]))
+        self.assertCounters(self.user2, inbox=1, unread=0)
+
+        self.c.get(reverse('messages_delete', args=[msg.pk]))
+        self.assertCounters(self.user2, inbox=0, unread=0, trash=1)
+
+        self.c.get(reverse('messages_undelete', args=[msg.pk]))
+        self.assertCounters(self.user2, inbox=1, trash=0)
+
+    def testPurge(self):
+        msg = self.send(self.user1, [self.user2])[0]
+        msg.sender_deleted_at = timezone.now() - datetime.timedelta(days=2)
+        msg.recipient_deleted_at = msg.sender_deleted_at
+        msg.save()
+        self.assertCounters(self.user1, outbox=0, trash=1)
+        call_command('delete_deleted_messages', 1, stdout=StringIO())
+        self.assertCounters(self.user1, outbox=0, trash=0)
+        self.assertCounters(self.user2, inbox=0, trash=0)
+
+    def testMessageToSelf(self):
+        msg = self.send(self.user1, [self.user1])[0]
+        msg.sender_deleted_at = msg.recipient_deleted_at = timezone.now()
+        msg.save()
+        self.assertCounters(self.user1, inbox=0, outbox=0, trash=1)
+
+    def testRebuild(self):
+        self.send(self.user1, [self.user2])
+        MailboxCounters.objects.filter(pk=self.user2.pk).update(unread=42)
+        call_command('rebuild_mailbox_counters', verbosity=0)
+        self.assertCounters(self.user2, unread=1)
+
+    def testDeferredFields(self):
+        self.send(self.user1, [self.user2])
+        msg = Message.objects.defer('read_at').get()
+        self.assertEqual(Message.objects.only('subject').get(), msg)
+        msg.read_at = timezone.now()
+        msg.save()
+        self.assertCounters(self.user2, inbox=1, unread=0)
+
+    def testFanOutWrites(self):
+        users = [User.objects.create_user('user%d' % i) for i in range(3, 13)]
+        MailboxCounters.objects.rebuild(
+            user_ids=[u.pk for u in users[:5]] + [self.user1.pk])
+        with CaptureQueriesContext(connection) as queries:
+            Message.objects.send(self.user1, users, 'S', 'B')
+        table = MailboxCounters._meta.db_table
+        # one UPDATE for all recipients and one for the sender, the
+        # missing rows are created at once
+        self.assertEqual(len([q for q in queries if q['sql'].startswith(
+            'UPDATE "%s"' % table)]), 2)
+        self.assertEqual(len([q for q in queries if q['sql'].startswith(
+            'INSERT') and '"%s"' % table in q['sql']]), 1)
+        for user in users:
+            self.assertCounters(user, inbox=1, unread=1)
+        self.assertCounters(self.user1, outbox=10)
+
+    def testBadgeQueries(self):
+        self.send(self.user1, [self.user2])
+        with self.assertNumQueries(1):
+            self.assertEqual(inbox_count_for(self.user2), 1)
+        # the broadcasts are only counted if there are any
+        Broadcast.objects.create(sender=self.user1, subject='S', body='B')
+        with self.assertNumQueries(2):
+            self.assertEqual(inbox_count_for(self.user2), 2)
+
+    def testMissingRow(self):
+        self.send(self.user1, [self.user2])
+        MailboxCounters.objects.all().delete()
+        self.assertEqual(inbox_count_for(self.user2), 1)
+        self.assertCounters(self.user2, inbox=1, unread=1)
+
+
+@override_settings(DJANGO_MESSAGES_CACHE='default')
+class CachedInboxCountTestCase(TestCase):
+    def setUp(self):
+        # user ids are reused between tests, so are their versions
+        caches['default'].clear()
+        self.user1 = User.objects.create_user(
+            'user1', 'user1@example.com', '123456')
+        self.user2 = User.objects.create_user(
+            'user2', 'user2@example.com', '123456')
+        self.c = Client()
+        self.c.login(username='user2', password='123456')
+
+    def assertCachedCount(self, user, count):
+        self.assertEqual(inbox_count_for(user), count)
+        with self.assertNumQueries(0):
+            self.assertEqual(inbox_count_for(user), count)
+
+    def testInvalidation(self):
+        self.assertCachedCount(self.user2, 0)
+        form = ComposeForm({'recipient': 'user2', 'subject': 'S',
+                            'body': 'B'})
+        self.assertTrue(form.is_valid())
+        msg = form.save(sender=self.user1)[0]
+        self.assertCachedCount(self.user2, 1)
+
+        self.c.get(reverse('messages_detail', args=[msg.pk]))
+        self.assertCachedCount(self.user2, 0)
+
+        msg = Message.objects.create(sender=self.user1, recipient=self.user2,
+                                     subject='S', body='B')
+        self.assertCachedCount(self.user2, 1)
+        self.c.get(reverse('messages_delete', args=[msg.pk]))
+        self.assertCachedCount(self.user2, 0)
+        self.c.get(reverse('messages_undelete', args=[msg.pk]))
+        self.assertCachedCount(self.user2, 1)
+
+    def testBroadcasts(self):
+        from django.contrib import admin as django_admin
+        from django_messages.admin import BroadcastAdmin
+        group = Group.objects.create(name='group')
+        self.assertCachedCount(self.user2, 0)
+        Broadcast.objects.create(sender=self.user1, subject='S', body='B')
+        Broadcast.objects.create(sender=self.user1, group=group,
+                                 subject='S', body='B')
+        self.assertCachedCount(self.user2, 1)
+        self.user2.groups.add(group)
+        self.assertCachedCount(self.user2, 2)
+        group.user_set.remove(self.user2)
+        self.assertCachedCount(self.user2, 1)
+        group.user_set.add(self.user2)
+        self.assertCachedCount(self.user2, 2)
+        group.user_set.clear()
+        self.assertCachedCount(self.user2, 1)
+        request = RequestFactory().post('/')
+        BroadcastAdmin(Broadcast, django_admin.site).delete_queryset(
+            request, Broadcast.objects.all())
+        self.assertCachedCount(self.user2, 0)
+
+    def testTemplateTag(self):
+        template = Template("{% load inbox %}{% inbox_count %}")
+        self.assertEqual(template.render(Context({'user': self.user2})), "0")
+        with self.assertNumQueries(0):
+            template.render(Context({'user': self.user2}))
+
+
+class PaginationTestCase(TestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(
+            'user1', 'user1@example.com', '123456')
+        self.user2 = User.objects.create_user(
+            'user2', 'user2@example.com', '123456')
+        now = timezone.now()
+        for i in range(7):
+            Message.objects.create(sender=self.user1, recipient=self.user2,
+                                   subject='S%d' % i, body='B')
+        # include ties on sent_at, which are ordered by id
+        for i, msg in enumerate(Message.objects.order_by('id')):
+            Message.objects.filter(pk=msg.pk).update(
+                sent_at=now - datetime.timedelta(minutes=i // 2))
+        self.expected = list(Message.objects.order_by(
+            '-sent_at', '-id').values_list('pk', flat=True))
+
+    def testForwardAndBack(self):
+        queryset = Message.objects.inbox_for(self.user2)
+        pages = [paginate(queryset, per_page=3)]
+        while pages[-1].has_next:
+            pages.append(paginate(queryset, pages[-1].next_cursor, 3))
+        self.assertEqual([len(page) for page in pages], [3, 3, 1])
+        self.assertEqual([m.pk for page in pages for m in page],
+                         self.expected)
+        self.assertFalse(pages[0].has_previous)
+
+        page = paginate(queryset, pages[-1].previous_cursor, 3)
+        self.assertEqual([m.pk for m in page], self.expected[3:6])
+        page = paginate(queryset, page.previous_cursor, 3)
+        self.assertEqual([m.pk for m in page], self.expected[:3])
+        self.assertFalse(page.has_previous)
+        self.assertTrue(page.has_next)
+
+    def testInvalidCursor(self):
+        queryset = Message.objects.inbox_for(self.user2)
+        self.assertRaises(InvalidCursor, paginate, queryset, 'garbage')
+        c = Client()
+        c.login(username='user2', password='123456')
+        response = c.get(reverse('messages_inbox'), {'cursor': 'garbage'})
+        self.assertEqual(response.status_code, 404)
+
+    @override_settings(DJANGO_MESSAGES_PAGE_SIZE=5)
+    def testView(self):
+        c = Client()
+        c.login(username='user2', password='123456')
+        response = c.get(reverse('messages_inbox'))
+        self.assertEqual(len(response.context['message_list']), 5)
+        cursor = response.context['page'].next_cursor
+        self.assertContains(response, '?cursor=%s' % cursor)
+        response = c.get(reverse('messages_inbox'), {'cursor': cursor})
+        self.assertEqual([m.pk for m in response.context['message_list']],
+                         self.expected[5:])
+
+
+class ListQueryCountTestCase(TestCase):
+    """The folder views need a constant number of queries."""
+    def setUp(self):
+        self.user = User.objects.create_user(
+            'user1', 'user1@example.com', '123456')
+        self.c = Client()
+        self.c.login(username='user1', password='123456')
+
+    def send(self, count):
+        for i in range(count):
+            other = User.objects.create_user(
+                'other%d_%d' % (count, i), 'o@example.com', '123456')
+            Message.objects.create(sender=other, recipient=self.user,
+                                   subject='S', body='B')
+            Message.objects.create(sender=self.user, recipient=other,
+                                   subject='S', body='B')
+            msg = Message.objects.create(sender=self.user, recipient=other,
+                                         subject='S', body='B')
+            Message.objects.filter(pk=msg.pk).update(
+                sender_deleted_at=timezone.now())
+
+    def count_queries(self, url_name):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.c.get(reverse(url_name))
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def testFlat(self):
+        self.send(1)
+        before = dict((name, self.count_queries(name)) for name in
+                      ('messages_inbox', 'messages_outbox', 'messages_trash'))
+        self.send(10)
+        after = dict((name, self.count_queries(name)) for name in before)
+        self.assertEqual(before, after)
+
+
+class TrashPaginationTestCase(TestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(
+            'user1', 'user1@example.com', '123456')
+        self.user2 = User.objects.create_user(
+            'user2', 'user2@example.com', '123456')
+        now = timezone.now()
+        for i in range(9):
+            sender, recipient = [(self.user1, self.user2),
+                                 (self.user2, self.user1),
+                                 (self.user1, self.user1)][i % 3]
+            msg = Message.objects.create(sender=sender, recipient=recipient,
+                                         subject='S%d' % i, body='B')
+            Message.objects.filter(pk=msg.pk).update(
+                sent_at=now - datetime.timedelta(minutes=i),
+                sender_deleted_at=now, recipient_deleted_at=now)
+        self.expected = list(Message.objects.trash_for(self.user1).order_by(
+            '-sent_at', '-id').values_list('pk', flat=True))
+
+    def testMerge(self):
+        querysets = [Message.objects.trash_received_for(self.user1),
+                     Message.objects.trash_sent_for(self.user1)]
+        pages = [paginate(querysets, per_page=4)]
+        while pages[-1].has_next:
+            pages.append(paginate(querysets, pages[-1].next_cursor, 4))
+        # messages to oneself are listed once
+        self.assertEqual([m.pk for page in pages for m in page],
+                         self.expected)
+        self.assertEqual(len(self.expected), 9)
+        page = paginate(querysets, pages[-1].previous_cursor, 4)
+        self.assertEqual([m.pk for m in page], self.expected[4:8])
+
+    def testView(self):
+        c = Client()
+        c.login(username='user1', password='123456')
+        response = c.get(reverse('messages_trash'))
+        self.assertEqual([m.pk for m in response.context['message_list']],
+                         self.expected)
+
+
+class BulkSendTestCase(TestCase):
+    def setUp(self):
+        self.sender = User.objects.create_user(
+            'sender', 'sender@example.com', '123456')
+        self.recipients = [
+            User.objects.create_user('user%d' % i, 'user%d@example.com' % i,
+                                     '123456')
+            for i in range(20)]
+        self.parent = Message.objects.create(
+            sender=self.recipients[0], recipient=self.sender,
+            subject='S', body='B')
+
+    def testSend(self):
+        mail.outbox = []
+        with CaptureQueriesContext(connection) as queries:
+            messages = Message.objects.send(
+                self.sender, self.recipients, 'Subject', 'Body',
+                parent_msg=self.parent)
+        inserts = [q for q in queries if q['sql'].startswith('INSERT')]
+        updates = [q for q in queries if q['sql'].startswith('UPDATE')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(len(messages), 20)
+        self.assertTrue(all(m.pk for m in messages))
+        self.assertEqual(
+            sorted(m.recipient.pk for m in messages),
+            sorted(u.pk for u in self.recipients))
+        self.assertEqual(Message.objects.outbox_for(self.sender).count(), 20)
+        self.parent.refresh_from_db()
+        self.assertEqual(self.parent.replied_at, messages[0].sent_at)
+        # post_save is still sent for every message
+        self.assertEqual(len(mail.outbox), 20)
+
+    @override_settings(DJANGO_MESSAGES_COUNTERS=True)
+    def testCounters(self):
+        MailboxCounters.objects.counts_for(self.sender)
+        Message.objects.send(self.sender, self.recipients, 'S', 'B')
+        self.assertEqual(
+            MailboxCounters.objects.get(pk=self.sender.pk).outbox, 20)
+        self.assertEqual(inbox_count_for(self.recipients[1]), 1)
+
+
+class BroadcastTestCase(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_user(
+            'admin', 'admin@example.com', '123456')
+        self.users = [
+            User.objects.create_user('user%d' % i, 'user%d@example.com' % i,
+                                     '123456')
+            for i in range(7)]
+
+    def testChunks(self):
+        job = BroadcastJob.objects.create(
+            sender=self.admin, exclude_user=self.users[0],
+            subject='S', body='B')
+        run_broadcast(job, chunk_size=3)
+        job.refresh_from_db()
+        self.assertEqual(job.status, BroadcastJob.DONE)
+        self.assertEqual(job.total, 7)
+        self.assertEqual(job.sent_count, 7)
+        # everybody but the excluded user, including the sender
+        self.assertEqual(
+            set(Message.objects.values_list('recipient', flat=True)),
+            set(u.pk for u in self.users[1:] + [self.admin]))
+
+    def testResume(self):
+        job = BroadcastJob.objects.create(sender=self.admin, subject='S',
+                                          body='B', status=BroadcastJob.RUNNING)
+        run_broadcast(job, chunk_size=3)
+        # pretend the worker died after the first chunk
+        Message.objects.filter(recipient__pk__gt=self.users[1].pk).delete()
+        BroadcastJob.objects.filter(pk=job.pk).update(
+            status=BroadcastJob.RUNNING, last_user_pk=str(self.users[1].pk),
+            sent_count=3)
+        self.assertEqual(run_pending_broadcasts(chunk_size=3), 1)
+        job.refresh_from_db()
+        self.assertEqual(job.sent_count, 8)
+        self.assertEqual(Message.objects.count(), 8)
+        self.assertEqual(run_pending_broadcasts(), 0)
+
+    @override_settings(DJANGO_MESSAGES_BROADCAST_CHUNK_SIZE=5000)
+    def testChunkSize(self):
+        from django_messages.broadcast import (SQLITE_MAX_CHUNK_SIZE,
+            get_chunk_size)
+        if connection.vendor == 'sqlite':
+            self.assertEqual(get_chunk_size(), SQLITE_MAX_CHUNK_SIZE)
+        else:
+            self.assertEqual(get_chunk_size(), 5000)
+
+    def testSendReadBack(self):
+        with CaptureQueriesContext(connection) as queries:
+            messages = Message.objects.send(self.admin, self.users, 'S', 'B')
+        self.assertEqual([m.recipient for m in messages], self.users)
+        self.assertTrue(all(m.pk for m in messages))
+        # the recipients of a chunk aren't passed to the database again
+        self.assertFalse(any('"recipient_id" IN' in q['sql']
+                             for q in queries.captured_queries))
+
+    def saveInAdmin(self):
+        from django.contrib import admin as django_admin
+        from django_messages.admin import MessageAdmin, MessageAdminForm
+        form = MessageAdminForm({
+            'sender': self.admin.pk, 'recipient': self.users[0].pk,
+            'group': 'all', 'subject': 'S', 'body': 'B'})
+        self.assertTrue(form.is_valid(), form.errors)
+        request = RequestFactory().post('/')
+        request._messages = CookieStorage(request)
+        MessageAdmin(Message, django_admin.site).save_model(
+            request, form.save(commit=False), form, False)
+
+    def testAdmin(self):
+        self.saveInAdmin()
+        self.assertEqual(Message.objects.count(), 8)
+        self.assertEqual(BroadcastJob.objects.get().status,
+                         BroadcastJob.DONE)
+
+    @override_settings(DJANGO_MESSAGES_BACKGROUND_BROADCAST=True)
+    def testAdminBackground(self):
+        self.saveInAdmin()
+        self.assertEqual(Message.objects.count(), 1)
+        call_command('send_broadcasts', verbosity=0)
+        self.assertEqual(Message.objects.count(), 8)
+
+
+class CountingEmailBackend(EmailBackend):
+    """
+    Counts opened connections, fails for one address and loses the
+    connection at another.
+    """
+    opened = 0
+
+    def open(self):
+        CountingEmailBackend.opened += 1
+        self.connected = True
+        return True
+
+    def close(self):
+        self.connected = False
+
+    def send_messages(self, messages):
+        if not getattr(self, 'connected', False):
+            raise smtplib.SMTPServerDisconnected('please run connect() first')
+        for message in messages:
+            if 'broken@example.com' in message.to:
+                raise IOError('mailbox unavailable')
+            if 'dropped@example.com' in message.to:
+                self.connected = False
+                raise smtplib.SMTPServerDisconnected('connection lost')
+        return super(CountingEmailBackend, self).send_messages(messages)
+
+
+@override_settings(
+    EMAIL_BACKEND='django_messages.tests.CountingEmailBackend',
+    DJANGO_MESSAGES_EMAIL_QUEUE=True)
+class EmailQueueTestCase(TestCase):
+    def setUp(self):
+        self.sender = User.objects.create_user(
+            'sender', 'sender@example.com', '123456')
+        self.recipients = [
+            User.objects.create_user('user%d' % i, 'user%d@example.com' % i,
+                                     '123456')
+            for i in range(5)]
+        self.broken = User.objects.create_user(
+            'broken', 'broken@example.com', '123456')
+        signals.post_save.disconnect(new_message_email, sender=Message)
+        signals.post_save.connect(queue_message_email, sender=Message)
+        self.addCleanup(signals.post_save.connect, new_message_email,
+                        sender=Message)
+        self.addCleanup(signals.post_save.disconnect, queue_message_email,
+                        sender=Message)
+        CountingEmailBackend.opened = 0
+        mail.outbox = []
+
+    def testQueue(self):
+        Message.objects.send(self.sender, self.recipients + [self.broken],
+                             'Subject', 'Body')
+        self.assertEqual(QueuedEmail.objects.count(), 6)
+        self.assertEqual(len(mail.outbox), 0)
+
+        self.assertEqual(send_queued_emails(batch_size=2), 5)
+        self.assertEqual(CountingEmailBackend.opened, 1)
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox),
+                         sorted(u.email for u in self.recipients))
+        self.assertIn('Subject', mail.outbox[0].subject)
+
+        # the failed row is retried later
+        queued = QueuedEmail.objects.get()
+        self.assertEqual(queued.attempts, 1)
+        self.assertIn('mailbox unavailable', queued.last_error)
+        self.assertTrue(queued.next_attempt_at > timezone.now())
+        self.assertEqual(send_queued_emails(), 0)
+
+    def testBulkInsert(self):
+        with CaptureQueriesContext(connection) as queries:
+            Message.objects.send(self.sender, self.recipients, 'S', 'B')
+        self.assertEqual(len([
+            q for q in queries if q['sql'].startswith('INSERT') and
+            QueuedEmail._meta.db_table in q['sql']]), 1)
+        self.assertEqual(QueuedEmail.objects.count(), 5)
+        # single saves are still queued
+        Message.objects.create(sender=self.sender,
+                               recipient=self.recipients[0],
+                               subject='S', body='B')
+        self.assertEqual(QueuedEmail.objects.count(), 6)
+
+    def testReconnect(self):
+        dropped = User.objects.create_user(
+            'dropped', 'dropped@example.com', '123456')
+        Message.objects.send(self.sender, [dropped], 'S', 'B')
+        Message.objects.send(self.sender, self.recipients, 'S', 'B')
+        self.assertEqual(send_queued_emails(), 5)
+        self.assertEqual(CountingEmailBackend.opened, 2)
+        queued = QueuedEmail.objects.get()
+        self.assertEqual(queued.message.recipient, dropped)
+        self.assertIn('connection lost', queued.last_error)
+
+    @override_settings(DJANGO_MESSAGES_EMAIL_MAX_ATTEMPTS=2)
+    def testGiveUp(self):
+        Message.objects.send(self.sender, [self.broken], 'S', 'B')
+        for i in range(2):
+            QueuedEmail.objects.update(next_attempt_at=timezone.now())
+            call_command('send_queued_emails', verbosity=0)
+        queued = QueuedEmail.objects.get()
+        self.assertEqual(queued.attempts, 2)
+        self.assertIsNotNone(queued.failed_at)
+
+
+class FanOutOnReadTestCase(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_user(
+            'admin', 'admin@example.com', '123456')
+        self.user1 = User.objects.create_user(
+            'user1', 'user1@example.com', '123456')
+        self.user2 = User.objects.create_user(
+            'user2', 'user2@example.com', '123456')
+        self.group = Group.objects.create(name='group')
+        self.user2.groups.add(self.group)
+        self.to_all = Broadcast.objects.create(
+            sender=self.admin, subject='To all', body='B')
+        self.to_group = Broadcast.objects.create(
+            sender=self.admin, group=self.group, subject='To group', body='B')
+        self.c = Client()
+        self.c.login(username='user1', password='123456')
+
+    def testVisibility(self):
+        self.assertEqual(list(Broadcast.objects.inbox_for(self.user1)),
+                         [self.to_all])
+        self.assertEqual(list(Broadcast.objects.inbox_for(self.user2)),
+                         [self.to_group, self.to_all])
+        self.assertEqual(inbox_count_for(self.user2), 2)
+        # no state rows until somebody reads or deletes
+        self.assertEqual(BroadcastState.objects.count(), 0)
+
+    def testInbox(self):
+        msg = Message.objects.create(sender=self.user2, recipient=self.user1,
+                                     subject='Message', body='B')
+        response = self.c.get(reverse('messages_inbox'))
+        self.assertEqual(list(response.context['message_list']),
+                         [msg, self.to_all])
+        self.assertContains(response, self.to_all.get_absolute_url())
+        self.assertEqual(inbox_count_for(self.user1), 2)
+
+    def testReadAndDelete(self):
+        url = reverse('messages_broadcast_detail', args=[self.to_all.pk])
+        response = self.c.get(url)
+        self.assertContains(response, 'To all')
+        self.assertEqual(inbox_count_for(self.user1), 0)
+        self.assertEqual(inbox_count_for(self.user2), 2)
+        self.assertFalse(Broadcast.objects.inbox_for(self.user1)[0].new())
+
+        self.c.get(reverse('messages_broadcast_delete',
+                           args=[self.to_all.pk]))
+        self.assertEqual(Broadcast.objects.inbox_for(self.user1).count(), 0)
+        self.assertEqual(self.c.get(url).status_code, 404)
+        self.assertEqual(BroadcastState.objects.count(), 1)
+
+    def testOtherGroup(self):
+        url = reverse('messages_broadcast_detail', args=[self.to_group.pk])
+        self.assertEqual(self.c.get(url).status_code, 404)
+
+
+class ThreadTestCase(TestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(
+            'user1', 'user1@example.com', '123456')
+        self.user2 = User.objects.create_user(
+            'user2', 'user2@example.com', '123456')
+        self.user3 = User.objects.create_user(
+            'user3', 'user3@example.com', '123456')
+        self.root = Message.objects.create(
+            sender=self.user1, recipient=self.user2, subject='S', body='B')
+        self.reply = Message.objects.send(
+            self.user2, [self.user1, self.user3], 'Re: S', 'B',
+            parent_msg=self.root)
+        self.reply2 = Message.objects.create(
+            sender=self.user1, recipient=self.user2, subject='Re: Re: S',
+            body='B', parent_msg=self.reply[0])
+        self.other = Message.objects.create(
+            sender=self.user1, recipient=self.user2, subject='Other', body='B')
+
+    def testThreadRoot(self):
+        self.assertIsNone(self.root.thread_root)
+        self.assertEqual([m.thread_root for m in self.reply],
+                         [self.root.pk, self.root.pk])
+        self.assertEqual(self.reply2.thread_root, self.root.pk)
+        self.assertEqual(self.reply2.depth, 2)
+
+    def testThreadFor(self):
+        with self.assertNumQueries(1):
+            messages = list(Message.objects.thread_for(
+                self.user1, self.reply2.pk))
+        self.assertEqual(messages, [self.root, self.reply[0], self.reply2])
+        self.assertEqual(list(Message.objects.thread_for(
+            self.user3, self.root)), [self.reply[1]])
+
+    def testView(self):
+        c = Client()
+        c.login(username='user2', password='123456')
+        response = c.get(reverse('messages_thread', args=[self.root.pk]))
+        self.assertEqual(list(response.context['message_list']),
+                         [self.root, self.reply[0], self.reply[1],
+                          self.reply2])
+        c.login(username='user3', password='123456')
+        response = c.get(reverse('messages_thread', args=[self.other.pk]))
+        self.assertEqual(response.status_code, 404)
+
+    def testBackfill(self):
+        reply3 = Message.objects.create(
+            sender=self.user2, recipient=self.user1, subject='Re: Re: Re: S',
+            body='B', parent_msg=self.reply2)
+        other_reply = Message.objects.create(
+            sender=self.user2, recipient=self.user1, subject='Re: Other',
+            body='B', parent_msg=self.other)
+        expected = list(Message.objects.order_by('pk').values_list(
+            'pk', 'thread_root', 'depth'))
+        Message.objects.update(thread_root=None, depth=0)
+        migration = importlib.import_module(
+            'django_messages.migrations.0012_backfill_message_threads')
+        with CaptureQueriesContext(connection) as queries:
+            migration.backfill_threads(apps, None)
+        self.assertEqual(list(Message.objects.order_by('pk').values_list(
+            'pk', 'thread_root', 'depth')), expected)
+        self.assertEqual(
+            Message.objects.filter(thread_root=self.root.pk).count(), 4)
+        self.assertEqual(other_reply.thread_root, self.other.pk)
+        self.assertEqual(reply3.depth, 3)
+        # one UPDATE per level, without reading the updated table in it
+        updates = [q['sql'] for q in queries if q['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 3)
+        for sql in updates:
+            self.assertNotIn('SELECT', sql)
+        # parents split over several statements
+        Message.objects.update(thread_root=None, depth=0)
+        with patch.object(migration, 'BATCH_SIZE', 1):
+            migration.backfill_threads(apps, None)
+        self.assertEqual(list(Message.objects.order_by('pk').values_list(
+            'pk', 'thread_root', 'depth')), expected)
+
+
+@override_settings(DJANGO_MESSAGES_COUNTERS=True)
+class BulkActionTestCase(TestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(
+            'user1', 'user1@example.com', '123456')
+        self.user2 = User.objects.create_user(
+            'user2', 'user2@example.com', '123456')
+        self.received = Message.objects.send(
+            self.user2, [self.user1], 'S', 'B') + [
+            Message.objects.create(sender=self.user2, recipient=self.user1,
+                                   subject='S', body='B')
+            for i in range(4)]
+        self.sent = Message.objects.send(self.user1, [self.user2], 'S', 'B')
+        self.c = Client()
+        self.c.login(username='user1', password='123456')
+
+    def post(self, **data):
+        response = self.c.post(reverse('messages_bulk_action'), data,
+                               HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, 200)
+        return response.json()['count']
+
+    def testIds(self):
+        ids = [m.pk for m in self.received[:2] + self.sent]
+        self.assertEqual(self.post(action='delete', message_id=ids), 3)
+        self.assertEqual(Message.objects.inbox_for(self.user1).count(), 3)
+        self.assertEqual(Message.objects.outbox_for(self.user1).count(), 0)
+        # the other side is untouched
+        self.assertEqual(Message.objects.inbox_for(self.user2).count(), 1)
+        self.assertEqual(inbox_count_for(self.user1), 3)
+        self.assertEqual(self.post(action='undelete', message_id=ids), 3)
+        self.assertEqual(Message.objects.trash_for(self.user1).count(), 0)
+
+    def testMessageToSelf(self):
+        own, = Message.objects.send(self.user1, [self.user1], 'S', 'B')
+        ids = [own.pk, self.sent[0].pk]
+        self.assertEqual(self.post(action='delete', message_id=ids), 2)
+        self.assertEqual(self.post(action='delete', message_id=ids), 0)
+        self.assertEqual(self.post(action='undelete', message_id=ids), 2)
+        # only one side in the trash
+        Message.objects.filter(pk=own.pk).update(
+            sender_deleted_at=timezone.now())
+        self.assertEqual(self.post(action='delete', message_id=[own.pk]), 1)
+
+    def testForeignMessages(self):
+        other = Message.objects.create(sender=self.user2,
+                                       recipient=self.user2,
+                                       subject='S', body='B')
+        self.assertEqual(self.post(action='delete', message_id=[other.pk]), 0)
+        self.assertEqual(self.post(action='read', message_id=[other.pk]), 0)
+
+    def testFolderConstantQueries(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.post(action='read', folder='inbox'), 5)
+        updates = [q for q in queries
+                   if q['sql'].startswith('UPDATE "django_messages_message"')]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(inbox_count_for(self.user1), 0)
+        self.assertEqual(self.post(action='unread', folder='inbox'), 5)
+        self.assertEqual(inbox_count_for(self.user1), 5)
+
+    def testInvalid(self):
+        response = self.c.post(reverse('messages_bulk_action'),
+                               {'action': 'explode', 'folder': 'inbox'})
+        self.assertEqual(response.status_code, 400)
+        response = self.c.get(reverse('messages_bulk_action'))
+        self.assertEqual(response.status_code, 405)
+
+    def testRedirect(self):
+        response = self.c.post(reverse('messages_bulk_action'),
+                               {'action': 'delete', 'folder': 'inbox'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Message.objects.inbox_for(self.user1).count(), 0)
+
+
+@override_settings(DJANGO_MESSAGES_COUNTERS=True)
+class TransitionTestCase(TestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(
+            'user1', 'user1@example.com', '123456')
+        self.user2 = User.objects.create_user(
+            'user2', 'user2@example.com', '123456')
+        self.msg = Message.objects.create(
+            sender=self.user1, recipient=self.user2, subject='S', body='B')
+
+    def counts(self, user):
+        counters = MailboxCounters.objects.counts_for(user)
+        return dict((field, getattr(counters, field))
+                    for field in ('unread', 'inbox', 'outbox', 'trash'))
+
+    def testMarkRead(self):
+        self.assertTrue(Message.objects.mark_read(self.msg))
+        self.assertIsNotNone(self.msg.read_at)
+        self.assertFalse(Message.objects.mark_read(self.msg))
+        self.assertEqual(self.counts(self.user2)['unread'], 0)
+
+    def testNoLostUpdate(self):
+        # a stale copy of the message must not undo a concurrent change
+        stale = Message.objects.get(pk=self.msg.pk)
+        Message.objects.mark_deleted_for(self.msg, self.user1)
+        Message.objects.mark_read(stale)
+        msg = Message.objects.get(pk=self.msg.pk)
+        self.assertIsNotNone(msg.sender_deleted_at)
+        self.assertIsNotNone(msg.read_at)
+
+    def testDeleteRestore(self):
+        self.assertTrue(Message.objects.mark_deleted_for(self.msg, self.user2))
+        self.assertFalse(Message.objects.mark_deleted_for(self.msg, self.user2))
+        self.assertEqual(self.counts(self.user2),
+                         {'unread': 0, 'inbox': 0, 'outbox': 0, 'trash': 1})
+        self.assertEqual(self.counts(self.user1)['outbox'], 1)
+        self.assertTrue(Message.objects.restore_for(self.msg, self.user2))
+        self.assertFalse(Message.objects.restore_for(self.msg, self.user2))
+        self.assertEqual(self.counts(self.user2),
+                         {'unread': 1, 'inbox': 1, 'outbox': 0, 'trash': 0})
+
+    def testOneColumnUpdate(self):
+        with CaptureQueriesContext(connection) as queries:
+            Message.objects.mark_replied(self.msg)
+        updates = [q['sql'] for q in queries if q['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        self.assertNotIn('"body"', updates[0])
+        later = self.msg.replied_at
+        self.assertFalse(Message.objects.mark_replied(
+            self.msg, later - datetime.timedelta(days=1)))
+        self.assertEqual(self.msg.replied_at, later)
+
+    def testViews(self):
+        c = Client()
+        c.login(username='user2', password='123456')
+        c.get(reverse('messages_detail', args=[self.msg.pk]))
+        self.assertIsNotNone(Message.objects.get(pk=self.msg.pk).read_at)
+        c.get(reverse('messages_delete', args=[self.msg.pk]))
+        self.assertIsNotNone(
+            Message.objects.get(pk=self.msg.pk).recipient_deleted_at)
+        c.get(reverse('messages_undelete', args=[self.msg.pk]))
+        self.assertIsNone(
+            Message.objects.get(pk=self.msg.pk).recipient_deleted_at)
+        self.assertEqual(self.counts(self.user2)['inbox'], 1)
+
+
+class PurgeTestCase(TestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(
+            'user1', 'user1@example.com', '123456')
+        self.user2 = User.objects.create_user(
+            'user2', 'user2@example.com', '123456')
+        deleted_at = timezone.now() - datetime.timedelta(days=2)
+        self.deleted = [
+            Message.objects.create(sender=self.user1, recipient=self.user2,
+                                   subject='S', body='B')
+            for i in range(5)]
+        Message.objects.filter(pk__in=[m.pk for m in self.deleted]).update(
+            sender_deleted_at=deleted_at, recipient_deleted_at=deleted_at)
+        self.reply = Message.objects.create(
+            sender=self.user2, recipient=self.user1, subject='S', body='B',
+            parent_msg=self.deleted[0])
+
+    def purge(self, *args):
+        out = StringIO()
+        call_command('delete_deleted_messages', 1, *args, stdout=out)
+        return out.getvalue()
+
+    def testDryRun(self):
+        out = self.purge('--dry-run')
+        self.assertIn('5 messages would be deleted, 1 replies', out)
+        self.assertEqual(Message.objects.count(), 6)
+
+    def testBatches(self):
+        with CaptureQueriesContext(connection) as queries:
+            out = self.purge('--batch-size', '2', '--verbosity', '2')
+        self.assertIn('Deleted 5 messages.', out)
+        self.assertEqual(out.count('Deleted'), 4)
+        deletes = [q for q in queries if q['sql'].startswith(
+            'DELETE FROM "django_messages_message"')]
+        self.assertEqual(len(deletes), 3)
+        self.assertEqual(list(Message.objects.all()), [self.reply])
+        self.reply.refresh_from_db()
+        self.assertIsNone(self.reply.parent_msg)
+        # the reply keeps its place in the conversation
+        self.assertEqual(self.reply.thread_root, self.deleted[0].pk)
+
+
+@override_settings(DJANGO_MESSAGES_COUNTERS=True)
+class ArchiveTestCase(TestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(
+            'user1', 'user1@example.com', '123456')
+        self.user2 = User.objects.create_user(
+            'user2', 'user2@example.com', '123456')
+        self.old = Message.objects.create(
+            sender=self.user1, recipient=self.user2, subject='Old', body='B')
+        self.old_reply = Message.objects.create(
+            sender=self.user2, recipient=self.user1, subject='Re: Old',
+            body='B', parent_msg=self.old)
+        self.active = Message.objects.create(
+            sender=self.user1, recipient=self.user2, subject='Active',
+            body='B')
+        self.recent_reply = Message.objects.create(
+            sender=self.user2, recipient=self.user1, subject='Re: Active',
+            body='B', parent_msg=self.active)
+        long_ago = timezone.now() - datetime.timedelta(days=400)
+        Message.objects.filter(
+            pk__in=[self.old.pk, self.old_reply.pk, self.active.pk],
+        ).update(sent_at=long_ago)
+
+    def archive(self, *args):
+        out = StringIO()
+        call_command('archive_messages', 365, *args, stdout=out)
+        return out.getvalue()
+
+    def testArchivable(self):
+        self.assertEqual(
+            set(Message.objects.archivable(
+                timezone.now() - datetime.timedelta(days=365))),
+            set([self.old, self.old_reply]))
+        self.assertIn('2 messages would be archived', self.archive('--dry-run'))
+        self.assertEqual(ArchivedMessage.objects.count(), 0)
+
+    def testArchive(self):
+        self.assertIn('Archived 2 messages.',
+                      self.archive('--batch-size', '1'))
+        self.assertEqual(set(Message.objects.all()),
+                         set([self.active, self.recent_reply]))
+        reply = ArchivedMessage.objects.get(pk=self.old_reply.pk)
+        self.assertEqual(reply.parent_id, self.old.pk)
+        self.assertEqual(reply.thread_root, self.old.pk)
+        self.assertEqual(
+            list(ArchivedMessage.objects.thread_for(self.user1, reply)),
+            [ArchivedMessage.objects.get(pk=self.old.pk), reply])
+        counters = MailboxCounters.objects.counts_for(self.user2)
+        self.assertEqual((counters.inbox, counters.unread), (1, 1))
+        self.assertEqual(inbox_count_for(self.user2), 1)
+
+    def testViews(self):
+        self.archive()
+        c = Client()
+        c.login(username='user1', password='123456')
+        response = c.get(reverse('messages_archive'))
+        self.assertEqual(
+            [m.pk for m in response.context['message_list']],
+            [self.old_reply.pk, self.old.pk])
+        response = c.get(reverse('messages_archive_detail',
+                                 args=[self.old.pk]))
+        self.assertEqual(len(response.context['message_list']), 2)
+        response = c.get(reverse('messages_archive_detail',
+                                 args=[self.active.pk]))
+        self.assertEqual(response.status_code, 404)
+        # the hot folders don't touch the archive
+        with CaptureQueriesContext(connection) as queries:
+            c.get(reverse('messages_inbox'))
+        self.assertFalse([q for q in queries
+                          if 'archivedmessage' in q['sql']])
+
+
+class SearchTestCase(TestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(
+            'user1', 'user1@example.com', '123456')
+        self.user2 = User.objects.create_user(
+            'user2', 'user2@example.com', '123456')
+        self.user3 = User.objects.create_user(
+            'user3', 'user3@example.com', '123456')
+        self.lunch = Message.objects.create(
+            sender=self.user1, recipient=self.user2, subject='Lunch',
+            body='Pizza on friday?')
+        self.meeting = Message.objects.create(
+            sender=self.user2, recipient=self.user1, subject='Meeting',
+            body='The meeting moved to friday.')
+        self.other = Message.objects.create(
+            sender=self.user3, recipient=self.user2, subject='Friday',
+            body='Not for user1.')
+
+    def search(self, user, query):
+        return set(Message.objects.search_for(user, query))
+
+    def testScope(self):
+        self.assertEqual(self.search(self.user1, 'friday'),
+                         set([self.lunch, self.meeting]))
+        self.assertEqual(self.search(self.user1, 'Friday pizza'),
+                         set([self.lunch]))
+        self.assertEqual(self.search(self.user3, 'pizza'), set())
+        Message.objects.mark_deleted_for(self.meeting, self.user1)
+        self.assertEqual(self.search(self.user1, 'meeting'), set())
+        self.assertEqual(self.search(self.user2, 'meeting'),
+                         set([self.meeting]))
+
+    def testSync(self):
+        # FTS5 operators are searched for as words
+        self.assertEqual(self.search(self.user2, '"pizza" OR'), set())
+        self.assertEqual(self.search(self.user2, '"pizza"'),
+                         set([self.lunch]))
+        self.lunch.body = 'Pasta then.'
+        self.lunch.save()
+        self.assertEqual(self.search(self.user2, 'pizza'), set())
+        self.assertEqual(self.search(self.user2, 'pasta'), set([self.lunch]))
+        reply, = Message.objects.send(
+            self.user1, [self.user2], 'Re: Lunch', 'Sushi?', self.lunch)
+        self.assertEqual(self.search(self.user2, 'sushi'), set([reply]))
+        reply.delete()
+        self.assertEqual(self.search(self.user2, 'sushi'), set())
+
+    @skipUnless(connection.vendor == 'sqlite', "FTS5 is SQLite specific")
+    def testFullTextIndex(self):
+        with CaptureQueriesContext(connection) as queries:
+            list(Message.objects.search_for(self.user1, 'friday'))
+        self.assertIn('django_messages_message_fts', queries[-1]['sql'])
+
+    @override_settings(DJANGO_MESSAGES_SEARCH_BACKEND=
+                       'django_messages.search.SimpleSearchBackend')
+    def testSimpleBackend(self):
+        self.assertEqual(self.search(self.user1, 'friday'),
+                         set([self.lunch, self.meeting]))
+        self.assertEqual(self.search(self.user1, 'pizza fri'),
+                         set([self.lunch]))
+
+    def testView(self):
+        c = Client()
+        c.login(username='user1', password='123456')
+        response = c.get(reverse('messages_search'), {'q': 'friday'})
+        self.assertEqual(len(response.context['message_list']), 2)
+        response = c.get(reverse('messages_search'))
+        self.assertEqual(response.context['message_list'], [])
+
+
+class RecipientFilterBatchTestCase(TestCase):
+    def setUp(self):
+        User.objects.bulk_create([
+            User(username='user%d' % i, is_active=i % 10 != 0)
+            for i in range(1000)])
+
+    def form(self, names, recipient_filter):
+        return ComposeForm(
+            {'recipient': ', '.join(names), 'subject': 'S', 'body': 'B'},
+            recipient_filter=recipient_filter)
+
+    def testOneQuery(self):
+        names = ['user%d' % i for i in range(1000) if i % 10]
+        form = self.form(names, RecipientFilter(Q(is_active=True)))
+        with self.assertNumQueries(1):
+            self.assertTrue(form.is_valid())
+        self.assertEqual(len(form.cleaned_data['recipient']), 900)
+
+    def testInvalidNames(self):
+        form = self.form(['user1', 'user10', 'user20', 'nobody', 'user1'],
+                         RecipientFilter(Q(is_active=True)))
+        with self.assertNumQueries(1):
+            self.assertFalse(form.is_valid())
+        self.assertIn('nobody, user10, user20',
+                      force_text(form.errors['recipient']))
+
+    def testPerUserFilter(self):
+        # consecutive rejected users must all be reported
+        form = self.form(['user10', 'user20', 'user30'],
+                         lambda u: u.is_active)
+        self.assertFalse(form.is_valid())
+        self.assertIn('user10, user20, user30',
+                      force_text(form.errors['recipient']))
+
+    def testIds(self):
+        users = User.objects.filter(username__in=['user1', 'user10'])
+        allowed = RecipientFilter(Q(is_active=True)).filter(
+            [u.pk for u in users])
+        self.assertEqual([u.username for u in allowed], ['user1'])
+        self.assertFalse(RecipientFilter(Q(is_active=True))(
+            User.objects.get(username='user10')))
+
+
+@override_settings(DJANGO_MESSAGES_CACHE='default',
+                   DJANGO_MESSAGES_AUTOCOMPLETE_LIMIT=3)
+class AutocompleteTestCase(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        for name in ('alice', 'albert', 'alfred', 'bob', 'Alina'):
+            User.objects.create_user(name, '%s@example.com' % name, '123456')
+        User.objects.filter(username='albert').update(is_active=False)
+        self.c = Client()
+        self.c.login(username='bob', password='123456')
+
+    def complete(self, q, **kwargs):
+        response = self.c.get(reverse('messages_autocomplete'), {'q': q})
+        return response.json()['results']
+
+    def testBounded(self):
+        self.assertEqual(self.complete('al'), ['Alina', 'albert', 'alfred'])
+        self.assertEqual(self.complete('bob, ali'), ['Alina', 'alice'])
+        self.assertEqual(self.complete(''), [])
+
+    def testCachedPrefixes(self):
+        self.complete('alf')
+        with self.assertNumQueries(2):
+            # session and user only
+            self.assertEqual(self.complete('alf'), ['alfred'])
+        with self.assertNumQueries(2):
+            self.assertEqual(self.complete('alfr'), ['alfred'])
+        with self.assertNumQueries(3):
+            # the result of "al" is incomplete
+            self.assertEqual(self.complete('ALI'), ['Alina', 'alice'])
+        with self.assertNumQueries(2):
+            self.assertEqual(self.complete('alic'), ['alice'])
+
+    def testRecipientFilter(self):
+        self.assertEqual(
+            complete_usernames('al', RecipientFilter(Q(is_active=True))),
+            ['Alina', 'alfred', 'alice'])
+        self.assertEqual(
+            complete_usernames('al', lambda u: u.is_active, scope='other'),
+            ['Alina', 'alfred', 'alice'])
+
+
+@override_settings(DJANGO_MESSAGES_CACHE='default')
+class ConditionalGetTestCase(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        self.user1 = User.objects.create_user(
+            'user1', 'user1@example.com', '123456')
+        self.user2 = User.objects.create_user(
+            'user2', 'user2@example.com', '123456')
+        self.msg = Message.objects.create(
+            sender=self.user2, recipient=self.user1, subject='S', body='B')
+        self.c = Client()
+        self.c.login(username='user1', password='123456')
+
+    def testETag(self):
+        url = reverse('messages_inbox')
+        etag = self.c.get(url)['ETag']
+        with self.assertNumQueries(2):
+            # session and user only
+            response = self.c.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        # pages of the same folder differ
+        self.assertNotEqual(self.c.get(url, {'cursor': 'x'}).get('ETag'), etag)
+        Message.objects.create(
+            sender=self.user2, recipient=self.user1, subject='S', body='B')
+        response = self.c.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['message_list']), 2)
+
+    def testDetail(self):
+        url = reverse('messages_detail', args=[self.msg.pk])
+        etag = self.c.get(url)['ETag']
+        # reading the message changed the mailbox
+        etag = self.c.get(url, HTTP_IF_NONE_MATCH=etag)['ETag']
+        response = self.c.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        Message.objects.mark_deleted_for(self.msg, self.user1)
+        response = self.c.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def testOtherUser(self):
+        url = reverse('messages_outbox')
+        etag = self.c.get(url)['ETag']
+        c = Client()
+        c.login(username='user2', password='123456')
+        response = c.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def testLastModified(self):
+        url = reverse('messages_trash')
+        with patch('time.time', return_value=time.time() - 60):
+            Message.objects.mark_read(self.msg)
+            Broadcast.objects.create(sender=self.user2, subject='S', body='B')
+        response = self.c.get(url)
+        last_modified = response['Last-Modified']
+        response = self.c.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+        Message.objects.mark_deleted_for(self.msg, self.user1)
+        response = self.c.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 200)
+        # the change happened within the current second
+        self.assertFalse(response.has_header('Last-Modified'))
+
+    def testUnreadCount(self):
+        url = reverse('messages_unread_count')
+        response = self.c.get(url)
+        self.assertEqual(response.json(), {'count': 1})
+        with self.assertNumQueries(2):
+            response = self.c.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def testWithoutCache(self):
+        with self.settings(DJANGO_MESSAGES_CACHE=None):
+            response = self.c.get(reverse('messages_inbox'))
+        self.assertFalse(response.has_header('ETag'))
+
+
+class ChangeStreamTestCase(TransactionTestCase):
+    def setUp(self):
+        changes._backend = None
+        self.user1 = User.objects.create_user(
+            'user1', 'user1@example.com', '123456')
+        self.user2 = User.objects.create_user(
+            'user2', 'user2@example.com', '123456')
+        self.c = Client()
+        self.c.login(username='user1', password='123456')
+
+    def open(self, **kwargs):
+        response = self.c.get(reverse('messages_stream'), **kwargs)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        return (force_text(chunk) for chunk in response.streaming_content)
+
+    def testBackend(self):
+        backend = changes.get_change_backend()
+        start = backend.current()
+        timer = threading.Timer(
+            0.1, backend.publish, [[self.user1.pk], {'type': 'changed'}])
+        timer.start()
+        sequence, events = backend.wait(self.user1.pk, start, 5)
+        timer.join()
+        self.assertEqual(events, [{'type': 'changed'}])
+        self.assertEqual(backend.wait(self.user2.pk, start, 0.01)[1], [])
+
+    def testStream(self):
+        events = self.open()
+        self.assertEqual(next(events), 'retry: 1000\n\n')
+        self.assertIn('data: {"count": 0}', next(events))
+        msg = Message.objects.create(
+            sender=self.user2, recipient=self.user1, subject='Hi', body='B')
+        event = next(events)
+        self.assertIn('event: message', event)
+        self.assertIn('"id": %d' % msg.pk, event)
+        self.assertIn('"sender": "user2"', event)
+        self.assertIn('data: {"count": 1}', next(events))
+        Message.objects.mark_read(msg)
+        self.assertIn('data: {"count": 0}', next(events))
+
+    @override_settings(DJANGO_MESSAGES_STREAM_TIMEOUT=0.2)
+    def testResume(self):
+        last_id = changes.get_change_backend().current()
+        Message.objects.send(self.user2, [self.user1], 'Hi', 'B')
+        events = list(self.open(HTTP_LAST_EVENT_ID=str(last_id)))
+        self.assertIn('event: message', events[2])
+        self.assertIn('data: {"count": 1}', events[3])
+
+    @override_settings(DJANGO_MESSAGES_STREAM_TIMEOUT=0.2)
+    def testHeartbeat(self):
+        response = self.c.get(reverse('messages_stream'))
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+        self.assertEqual(len(list(response.streaming_content)), 3)
+
+
+@override_settings(DJANGO_MESSAGES_INSTRUMENTATION_SINKS=[
+    'django_messages.instrumentation.MemorySink'])
+class InstrumentationTestCase(TestCase):
+    def setUp(self):
+        MemorySink.clear()
+        self.user1 = User.objects.create_user(
+            'user1', 'user1@example.com', '123456')
+        self.user2 = User.objects.create_user(
+            'user2', 'user2@example.com', '123456')
+
+    def events(self, name):
+        return [e for e in MemorySink.events if e['operation'] == name]
+
+    def testManager(self):
+        Message.objects.send(self.user1, [self.user1, self.user2], 'S', 'B')
+        event, = self.events('messages.send')
+        self.assertEqual(event['rows'], 2)
+        self.assertGreater(event['queries'], 0)
+        self.assertGreaterEqual(event['duration_ms'], 0)
+        self.assertIsNone(event['error'])
+        Message.objects.mark_read_for(
+            self.user2, Message.objects.inbox_for(self.user2))
+        self.assertEqual(self.events('messages.mark_read_for')[0]['rows'], 1)
+
+    def testViewAndForm(self):
+        c = Client()
+        c.login(username='user1', password='123456')
+        MemorySink.clear()
+        c.post(reverse('messages_compose'), {
+            'recipient': 'user2', 'subject': 'S', 'body': 'B'})
+        self.assertEqual(self.events('forms.compose')[0]['rows'], 1)
+        self.assertEqual(len(self.events('email.new_message')), 1)
+        view, = self.events('views.compose')
+        send, = self.events('messages.send')
+        # nested operations are part of the outer one
+        self.assertGreater(view['queries'], send['queries'])
+
+    def testCommand(self):
+        call_command('delete_deleted_messages', 1, stdout=StringIO())
+        self.assertEqual(
+            len(self.events('commands.delete_deleted_messages')), 1)
+
+    def testError(self):
+        with self.assertRaises(ValueError):
+            with operation('custom'):
+                raise ValueError
+        self.assertEqual(self.events('custom')[0]['error'], 'ValueError')
+
+    @override_settings(DJANGO_MESSAGES_INSTRUMENTATION_SINKS=[])
+    def testDisabled(self):
+        Message.objects.send(self.user1, [self.user2], 'S', 'B')
+        self.assertEqual(MemorySink.events, [])
+
+
+class DomainSignalsTestCase(TestCase):
+    signals = (messages_sent, messages_read, messages_deleted,
+               messages_restored)
+
+    def setUp(self):
+        self.user1 = User.objects.create_user(
+            'user1', 'user1@example.com', '123456')
+        self.user2 = User.objects.create_user(
+            'user2', 'user2@example.com', '123456')
+        self.user3 = User.objects.create_user(
+            'user3', 'user3@example.com', '123456')
+        self.c = Client()
+        self.c.login(username='user2', password='123456')
+        self.sent = []
+        for signal in self.signals:
+            signal.connect(self.receive, sender=Message)
+
+    def tearDown(self):
+        for signal in self.signals:
+            signal.disconnect(self.receive, sender=Message)
+
+    def receive(self, signal, sender, messages, user, **kwargs):
+        self.sent.append((signal, [m.pk for m in messages], user))
+
+    def testCompose(self):
+        self.c.login(username='user1', password='123456')
+        self.c.post(reverse('messages_compose'), {
+            'recipient': 'user2,user3', 'subject': 'S', 'body': 'B'})
+        (signal, ids, user), = self.sent
+        self.assertEqual(signal, messages_sent)
+        self.assertEqual(sorted(ids), sorted(
+            Message.objects.values_list('pk', flat=True)))
+        self.assertEqual(len(ids), 2)
+        self.assertEqual(user, self.user1)
+
+    def testViews(self):
+        msg, = Message.objects.send(self.user1, [self.user2], 'S', 'B')
+        del self.sent[:]
+        self.c.get(reverse('messages_detail', args=[msg.pk]))
+        # reading again changes nothing
+        self.c.get(reverse('messages_detail', args=[msg.pk]))
+        self.c.get(reverse('messages_delete', args=[msg.pk]))
+        self.c.get(reverse('messages_undelete', args=[msg.pk]))
+        self.assertEqual(self.sent, [
+            (messages_read, [msg.pk], self.user2),
+            (messages_deleted, [msg.pk], self.user2),
+            (messages_restored, [msg.pk], self.user2),
+        ])
+
+    def testBulkActions(self):
+        received = Message.objects.send(self.user1, [self.user2], 'S', 'B')
+        received += Message.objects.send(self.user3, [self.user2], 'S', 'B')
+        mine = Message.objects.send(self.user2, [self.user2], 'S', 'B')
+        ids = sorted(m.pk for m in received + mine)
+        del self.sent[:]
+        for action in ('read', 'delete', 'undelete'):
+            self.c.post(reverse('messages_bulk_action'), {
+                'action': action, 'message_id': ids})
+        # one dispatch per action, a message to oneself is passed once
+        self.assertEqual(self.sent, [
+            (messages_read, ids, self.user2),
+            (messages_deleted, ids, self.user2),
+            (messages_restored, ids, self.user2),
+        ])
+        del self.sent[:]
+        self.c.post(reverse('messages_bulk_action'), {
+            'action': 'read', 'message_id': ids})
+        self.assertEqual(self.sent, [])
+
+    def testAdmin(self):
+        from django.contrib import admin as django_admin
+        from django_messages.admin import MessageAdmin, MessageAdminForm
+        form = MessageAdminForm({
+            'sender': self.user1.pk, 'recipient': self.user2.pk,
+            'group': '', 'subject': 'S', 'body': 'B'})
+        self.assertTrue(form.is_valid(), form.errors)
+        request = RequestFactory().post('/')
+        request._messages = CookieStorage(request)
+        MessageAdmin(Message, django_admin.site).save_model(
+            request, form.save(commit=False), form, False)
+        msg = Message.objects.get()
+        self.assertEqual(self.sent, [(messages_sent, [msg.pk], self.user1)])
+
+    def testNoReceivers(self):
+        self.tearDown()
+        msg, = Message.objects.send(self.user1, [self.user2], 'S', 'B')
+        with CaptureQueriesContext(connection) as queries:
+            Message.objects.mark_read_for(
+                self.user2, Message.objects.filter(pk=msg.pk))
+        # the affected messages aren't fetched
+        self.assertFalse([q for q in queries
+                          if q['sql'].startswith('SELECT')])
+
+
+class PartialIndexFallbackTestCase(TransactionTestCase):
+    def mailbox_indexes(self):
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(
+                cursor, Message._meta.db_table)
+        return sorted(
+            constraint['columns'] for constraint in constraints.values()
+            if constraint['index'] and len(constraint['columns']) > 1 and
+            constraint['columns'][0] in ('recipient_id', 'sender_id'))
+
+    def migrate(self, target):
+        call_command('migrate', 'django_messages', target, verbosity=0)
+
+    def testFallback(self):
+        self.migrate('0003')
+        try:
+            with patch.object(connection.features,
+                              'supports_partial_indexes', False):
+                self.migrate('0007')
+                # one plain index per role instead of five partial ones
+                self.assertEqual(self.mailbox_indexes(), [
+                    ['recipient_id', 'sent_at', 'id'],
+                    ['sender_id', 'sent_at', 'id'],
+                ])
+                self.migrate('0003')
+                self.assertEqual(self.mailbox_indexes(), [])
+        finally:
+            self.migrate('0003')
+            call_command('migrate', verbosity=0)
+        self.assertEqual(len(self.mailbox_indexes()), 5)
+
+
+@skipUnless(connection.vendor == 'sqlite', "SQLite specific")
+class SearchTriggersTestCase(TransactionTestCase):
+    def triggers(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT name FROM sqlite_master "
+                           "WHERE type = 'trigger'")
+            return set(row[0] for row in cursor.fetchall())
+
+    def alter_subject(self, max_length):
+        old_field = Message._meta.get_field('subject')
+        new_field = models.CharField(max_length=max_length)
+        new_field.set_attributes_from_name('subject')
+        with connection.schema_editor() as editor:
+            editor.alter_field(Message, old_field, new_field)
+
+    def testTableRebuild(self):
+        if search.FTS_TABLE not in connection.introspection.table_names():
+            self.skipTest("SQLite without FTS5")
+        user = User.objects.create_user('user1', 'user1@example.com', '1')
+        try:
+            # SQLite rebuilds the table, which drops the triggers
+            self.alter_subject(200)
+            self.assertEqual(self.triggers(), set())
+            msg = Message.objects.create(
+                sender=user, recipient=user, subject='Lunch', body='B')
+            call_command('migrate', verbosity=0)
+            self.assertEqual(self.triggers(), set(search.SQLITE_TRIGGERS))
+            # the message created meanwhile is indexed as well
+            self.assertEqual(list(Message.objects.search_for(user, 'lunch')),
+                             [msg])
+        finally:
+            self.alter_subject(140)
+            search.restore_sqlite_triggers()
@@ -9,9 +9,19 @@ urlpatterns = [
     url(r'^outbox/$', outbox, name='messages_outbox'),
     url(r'^compose/$', compose, name='messages_compose'),
     url(r'^compose/(?P<recipient>[\w.@+-]+)/$', compose, name='messages_compose_to'),
+    url(r'^autocomplete/$', autocomplete, name='messages_autocomplete'),
     url(r'^reply/(?P<message_id>[\d]+)/$', reply, name='messages_reply'),
     url(r'^view/(?P<message_id>[\d]+)/$', view, name='messages_detail'),
+    url(r'^thread/(?P<message_id>[\d]+)/$', thread, name='messages_thread'),
     url(r'^delete/(?P<message_id>[\d]+)/$', delete, name='messages_delete'),
     url(r'^undelete/(?P<message_id>[\d]+)/$', undelete, name='messages_undelete'),
     url(r'^trash/$', trash, name='messages_trash'),
+    url(r'^search/$', search, name='messages_search'),
+    url(r'^archive/$', archive, name='messages_archive'),
+    url(r'^archive/(?P<message_id>[\d]+)/$', view_archived, name='messages_archive_detail'),
+    url(r'^bulk/$', bulk_action, name='messages_bulk_action'),
+    url(r'^unread/$', unread_count, name='messages_unread_count'),
+    url(r'^stream/$', stream, name='messages_stream'),
+    url(r'^broadcast/(?P<broadcast_id>[\d]+)/$', view_broadcast, name='messages_broadcast_detail'),
+    url(r'^broadcast/(?P<broadcast_id>[\d]+)/delete/$', delete_broadcast, name='messages_broadcast_delete'),
 ]
@@ -5,6 +5,8 @@ from django.utils.translation import ugettext, ugettext_lazy as _
 from django.template.loader import render_to_string
 from django.conf import settings
 
+from django_messages.instrumentation import instrumented
+
 # favour django-mailer but fall back to django.core.mail
 
 if "mailer" in settings.INSTALLED_APPS:
@@ -55,6 +57,30 @@ def format_subject(subject):
         'prefix': prefix
     }
 
+def get_site_url(default_protocol=None):
+    """
+    Returns the URL of the current site, e.g. ``http://example.com``.
+    """
+    from django.contrib.sites.models import Site
+    if default_protocol is None:
+        default_protocol = getattr(settings, 'DEFAULT_HTTP_PROTOCOL', 'http')
+    return '%s://%s' % (default_protocol, Site.objects.get_current().domain)
+
+def render_message_email(message, site_url,
+        subject_prefix=_(u'New Message: %(subject)s'),
+        template_name="django_messages/new_message.html"):
+    """
+    Returns the subject and body of the notification email about the given
+    message.
+    """
+    subject = subject_prefix % {'subject': message.subject}
+    body = render_to_string(template_name, {
+        'site_url': site_url,
+        'message': message,
+    })
+    return subject, body
+
+@instrumented('email.new_message')
 def new_message_email(sender, instance, signal,
         subject_prefix=_(u'New Message: %(subject)s'),
         template_name="django_messages/new_message.html",
@@ -67,18 +93,11 @@ def new_message_email(sender, instance, signal,
         ``subject_prefix``: prefix for the email subject.
         ``default_protocol``: default protocol in site URL passed to template
     """
-    if default_protocol is None:
-        default_protocol = getattr(settings, 'DEFAULT_HTTP_PROTOCOL', 'http')
-
     if 'created' in kwargs and kwargs['created']:
         try:
-            from django.contrib.sites.models import Site
-            current_domain = Site.objects.get_current().domain
-            subject = subject_prefix % {'subject': instance.subject}
-            message = render_to_string(template_name, {
-                'site_url': '%s://%s' % (default_protocol, current_domain),
-                'message': instance,
-            })
+            subject, message = render_message_email(
+                instance, get_site_url(default_protocol),
+                subject_prefix=subject_prefix, template_name=template_name)
             if instance.recipient.email != "":
                 send_mail(subject, message, settings.DEFAULT_FROM_EMAIL,
                     [instance.recipient.email,])
@@ -96,6 +115,15 @@ def get_user_model():
         return User
 
 
+def user_is_authenticated(user):
+    # django < 2.0
+    try:
+        return user.is_authenticated()
+    except TypeError:
+        # django >= 2.0
+        return user.is_authenticated
+
+
 def get_username_field():
     if django.VERSION[:2] >= (1, 5):
         return get_user_model().USERNAME_FIELD
@@ -1,18 +1,31 @@
-from django.http import Http404, HttpResponseRedirect
+import datetime
+import hashlib
+import json
+import time
+
+from django.http import (Http404, HttpResponseBadRequest,
+    HttpResponseRedirect, JsonResponse, StreamingHttpResponse)
 from django.shortcuts import render, get_object_or_404
-from django.template import RequestContext
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from django.utils.translation import ugettext as _
-from django.utils import timezone
+from django.views.decorators.http import condition, require_POST
+from django.utils.encoding import force_bytes
+from django.utils.translation import ugettext as _, ugettext_lazy
 try:
     from django.core.urlresolvers import reverse
 except ImportError:
     from django.urls import reverse
 from django.conf import settings
 
-from django_messages.models import Message
+from django_messages.models import (ArchivedMessage, Broadcast, Message,
+    inbox_count_for)
+from django_messages.autocomplete import complete_usernames
+from django_messages.cache import get_mailbox_etag, get_mailbox_modified
+from django_messages.changes import get_change_backend
+from django_messages.context_processors import request_inbox_count
 from django_messages.forms import ComposeForm
+from django_messages.instrumentation import instrumented
+from django_messages.pagination import InvalidCursor, paginate
 from django_messages.utils import format_quote, get_user_model, get_username_field
 
 User = get_user_model()
@@ -22,45 +35,154 @@ if "pinax.notifications" in settings.INSTALLED_APPS and getattr(settings, 'DJANG
 else:
     notification = None
 
+def _mailbox_etag(request, *args, **kwargs):
+    version = get_mailbox_etag(request.user.pk)
+    if version is None:
+        return None
+    return hashlib.md5(force_bytes('%s:%s:%s' % (
+        request.user.pk, version, request.get_full_path()))).hexdigest()
+
+def _mailbox_last_modified(request, *args, **kwargs):
+    modified = get_mailbox_modified(request.user.pk)
+    # Last-Modified has a resolution of one second, changes within the
+    # current second could still follow
+    if modified is None or modified >= int(time.time()):
+        return None
+    return datetime.datetime.utcfromtimestamp(modified)
+
+# Answers conditional GET requests with 304 Not Modified as long as the
+# mailbox of the user didn't change. Needs ``DJANGO_MESSAGES_CACHE``.
+mailbox_condition = condition(etag_func=_mailbox_etag,
+                              last_modified_func=_mailbox_last_modified)
+
+def _folder_context(request, querysets, per_page):
+    """
+    Returns the template context for the page of ``querysets`` requested via
+    the ``cursor`` GET parameter.
+    """
+    try:
+        page = paginate(querysets, request.GET.get('cursor'), per_page)
+    except InvalidCursor:
+        raise Http404
+    return {
+        'message_list': page.object_list,
+        'page': page,
+    }
+
 @login_required
-def inbox(request, template_name='django_messages/inbox.html'):
+@instrumented('views.inbox')
+@mailbox_condition
+def inbox(request, template_name='django_messages/inbox.html', per_page=None):
     """
-    Displays a list of received messages for the current user.
+    Displays a list of received messages and broadcasts for the current user.
     Optional Arguments:
         ``template_name``: name of the template to use.
+        ``per_page``: number of messages per page, defaults to the
+                      ``DJANGO_MESSAGES_PAGE_SIZE`` setting.
     """
-    message_list = Message.objects.inbox_for(request.user)
-    return render(request, template_name, {
-        'message_list': message_list,
-    })
+    message_list = [
+        Message.objects.inbox_for(request.user).select_related(
+            'sender').defer('body'),
+        Broadcast.objects.inbox_for(request.user).select_related(
+            'sender').defer('body'),
+    ]
+    return render(request, template_name,
+                  _folder_context(request, message_list, per_page))
 
 @login_required
-def outbox(request, template_name='django_messages/outbox.html'):
+@instrumented('views.outbox')
+@mailbox_condition
+def outbox(request, template_name='django_messages/outbox.html', per_page=None):
     """
     Displays a list of sent messages by the current user.
     Optional arguments:
         ``template_name``: name of the template to use.
+        ``per_page``: number of messages per page, defaults to the
+                      ``DJANGO_MESSAGES_PAGE_SIZE`` setting.
     """
-    message_list = Message.objects.outbox_for(request.user)
-    return render(request, template_name, {
-        'message_list': message_list,
-    })
+    message_list = Message.objects.outbox_for(request.user).select_related(
+        'recipient').defer('body')
+    return render(request, template_name,
+                  _folder_context(request, message_list, per_page))
 
 @login_required
-def trash(request, template_name='django_messages/trash.html'):
+@instrumented('views.trash')
+@mailbox_condition
+def trash(request, template_name='django_messages/trash.html', per_page=None):
     """
     Displays a list of deleted messages.
     Optional arguments:
         ``template_name``: name of the template to use
+        ``per_page``: number of messages per page, defaults to the
+                      ``DJANGO_MESSAGES_PAGE_SIZE`` setting.
     Hint: A Cron-Job could periodicly clean up old messages, which are deleted
     by sender and recipient.
     """
-    message_list = Message.objects.trash_for(request.user)
+    message_list = [
+        queryset.select_related('sender', 'recipient').defer('body')
+        for queryset in (Message.objects.trash_received_for(request.user),
+                         Message.objects.trash_sent_for(request.user))
+    ]
+    return render(request, template_name,
+                  _folder_context(request, message_list, per_page))
+
+@login_required
+@instrumented('views.search')
+def search(request, template_name='django_messages/search.html', per_page=None):
+    """
+    Displays the messages in the inbox and outbox of the current user which
+    match the ``q`` GET parameter.
+    Optional arguments:
+        ``template_name``: name of the template to use
+        ``per_page``: number of messages per page, defaults to the
+                      ``DJANGO_MESSAGES_PAGE_SIZE`` setting.
+    """
+    query = request.GET.get('q', '').strip()
+    context = {'query': query, 'message_list': [], 'page': None}
+    if query:
+        message_list = Message.objects.search_for(
+            request.user, query,
+        ).select_related('sender', 'recipient').defer('body')
+        context.update(_folder_context(request, message_list, per_page))
+    return render(request, template_name, context)
+
+@login_required
+@instrumented('views.archive')
+def archive(request, template_name='django_messages/archive.html', per_page=None):
+    """
+    Displays the archived messages the current user received or sent. The
+    archive is only queried here, so the inbox and outbox stay fast.
+    Optional arguments:
+        ``template_name``: name of the template to use
+        ``per_page``: number of messages per page, defaults to the
+                      ``DJANGO_MESSAGES_PAGE_SIZE`` setting.
+    """
+    message_list = [
+        queryset.select_related('sender', 'recipient').defer('body')
+        for queryset in (ArchivedMessage.objects.inbox_for(request.user),
+                         ArchivedMessage.objects.outbox_for(request.user))
+    ]
+    return render(request, template_name,
+                  _folder_context(request, message_list, per_page))
+
+@login_required
+@instrumented('views.view_archived')
+def view_archived(request, message_id,
+                  template_name='django_messages/thread.html'):
+    """
+    Shows the archived conversation the message ``message_id`` belongs to,
+    limited to the messages the current user sent or received.
+    """
+    message_list = list(ArchivedMessage.objects.thread_for(
+        request.user, message_id).select_related('sender', 'recipient'))
+    if not message_list:
+        raise Http404
     return render(request, template_name, {
         'message_list': message_list,
     })
 
 @login_required
+@instrumented('views.compose')
 def compose(request, recipient=None, form_class=ComposeForm,
         template_name='django_messages/compose.html', success_url=None,
         recipient_filter=None):
@@ -76,7 +198,8 @@ def compose(request, recipient=None, form_class=ComposeForm,
         ``success_url``: where to redirect after successfull submission
         ``recipient_filter``: a function which receives a user object and
                               returns a boolean wether it is an allowed
-                              recipient or not
+                              recipient or not, or a ``RecipientFilter``
+                              which checks all recipients at once
 
     Passing GET parameter ``subject`` to the view allows pre-filling the
     subject field of the form.
@@ -102,6 +225,22 @@ def compose(request, recipient=None, form_class=ComposeForm,
     })
 
 @login_required
+@instrumented('views.autocomplete')
+def autocomplete(request, recipient_filter=None, limit=None):
+    """
+    Returns the usernames starting with the ``q`` GET parameter as JSON
+    (``{"results": [...]}``), for the recipient field of the compose form.
+    Optional arguments:
+        ``recipient_filter``: the same filter as passed to ``compose``
+        ``limit``: maximum number of usernames, defaults to the
+                   ``DJANGO_MESSAGES_AUTOCOMPLETE_LIMIT`` setting.
+    """
+    prefix = request.GET.get('q', '').split(',')[-1].strip()
+    return JsonResponse({'results': complete_usernames(
+        prefix, recipient_filter, limit, scope=request.path)})
+
+@login_required
+@instrumented('views.reply')
 def reply(request, message_id, form_class=ComposeForm,
         template_name='django_messages/compose.html', success_url=None,
         recipient_filter=None, quote_helper=format_quote,
@@ -138,6 +277,7 @@ def reply(request, message_id, form_class=ComposeForm,
     })
 
 @login_required
+@instrumented('views.delete')
 def delete(request, message_id, success_url=None):
     """
     Marks a message as deleted by sender or recipient. The message is not
@@ -151,21 +291,13 @@ def delete(request, message_id, success_url=None):
     page (e.g. `/foo/bar/`) than ``success_url`` after deletion of the message.
     """
     user = request.user
-    now = timezone.now()
     message = get_object_or_404(Message, id=message_id)
-    deleted = False
     if success_url is None:
         success_url = reverse('messages_inbox')
     if 'next' in request.GET:
         success_url = request.GET['next']
-    if message.sender == user:
-        message.sender_deleted_at = now
-        deleted = True
-    if message.recipient == user:
-        message.recipient_deleted_at = now
-        deleted = True
-    if deleted:
-        message.save()
+    if user.pk in (message.sender_id, message.recipient_id):
+        Message.objects.mark_deleted_for(message, user)
         messages.info(request, _(u"Message successfully deleted."))
         if notification:
             notification.send([user], "messages_deleted", {'message': message,})
@@ -173,6 +305,7 @@ def delete(request, message_id, success_url=None):
     raise Http404
 
 @login_required
+@instrumented('views.undelete')
 def undelete(request, message_id, success_url=None):
     """
     Recovers a message from trash. This is achieved by removing the
@@ -180,26 +313,67 @@ def undelete(request, message_id, success_url=None):
     """
     user = request.user
     message = get_object_or_404(Message, id=message_id)
-    undeleted = False
     if success_url is None:
         success_url = reverse('messages_inbox')
     if 'next' in request.GET:
         success_url = request.GET['next']
-    if message.sender == user:
-        message.sender_deleted_at = None
-        undeleted = True
-    if message.recipient == user:
-        message.recipient_deleted_at = None
-        undeleted = True
-    if undeleted:
-        message.save()
+    if user.pk in (message.sender_id, message.recipient_id):
+        Message.objects.restore_for(message, user)
         messages.info(request, _(u"Message successfully recovered."))
         if notification:
             notification.send([user], "messages_recovered", {'message': message,})
         return HttpResponseRedirect(success_url)
     raise Http404
 
+BULK_ACTIONS = {
+    'delete': (Message.objects.delete_for, ugettext_lazy(u"%(count)d messages successfully deleted.")),
+    'undelete': (Message.objects.undelete_for, ugettext_lazy(u"%(count)d messages successfully recovered.")),
+    'read': (Message.objects.mark_read_for, ugettext_lazy(u"%(count)d messages marked as read.")),
+    'unread': (Message.objects.mark_unread_for, ugettext_lazy(u"%(count)d messages marked as unread.")),
+}
+
+BULK_FOLDERS = {
+    'inbox': Message.objects.inbox_for,
+    'outbox': Message.objects.outbox_for,
+    'trash': Message.objects.trash_for,
+}
+
 @login_required
+@instrumented('views.bulk_action')
+@require_POST
+def bulk_action(request, success_url=None):
+    """
+    Applies the POSTed ``action`` (``delete``, ``undelete``, ``read`` or
+    ``unread``) to all messages given as ``message_id`` parameters, or to a
+    whole ``folder`` (``inbox``, ``outbox`` or ``trash``), of the current
+    user. Only the user's side of each message is changed.
+
+    Responds with the number of changed messages as JSON if the client
+    accepts JSON, otherwise redirects to ``success_url`` or ?next=.
+    """
+    user = request.user
+    try:
+        action, message = BULK_ACTIONS[request.POST.get('action')]
+        if 'folder' in request.POST:
+            queryset = BULK_FOLDERS[request.POST['folder']](user)
+        else:
+            ids = [int(pk) for pk in request.POST.getlist('message_id')]
+            queryset = Message.objects.filter(pk__in=ids)
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest()
+    count = action(user, queryset)
+    if 'application/json' in request.META.get('HTTP_ACCEPT', ''):
+        return JsonResponse({'count': count})
+    messages.info(request, message % {'count': count})
+    if success_url is None:
+        success_url = reverse('messages_inbox')
+    if 'next' in request.GET:
+        success_url = request.GET['next']
+    return HttpResponseRedirect(success_url)
+
+@login_required
+@instrumented('views.view')
+@mailbox_condition
 def view(request, message_id, form_class=ComposeForm, quote_helper=format_quote,
         subject_template=_(u"Re: %(subject)s"),
         template_name='django_messages/view.html'):
@@ -214,13 +388,11 @@ def view(request, message_id, form_class=ComposeForm, quote_helper=format_quote,
     tenplate context, otherwise 'reply_form' will be None.
     """
     user = request.user
-    now = timezone.now()
     message = get_object_or_404(Message, id=message_id)
     if (message.sender != user) and (message.recipient != user):
         raise Http404
     if message.read_at is None and message.recipient == user:
-        message.read_at = now
-        message.save()
+        Message.objects.mark_read(message)
 
     context = {'message': message, 'reply_form': None}
     if message.recipient == user:
@@ -231,3 +403,119 @@ def view(request, message_id, form_class=ComposeForm, quote_helper=format_quote,
             })
         context['reply_form'] = form
     return render(request, template_name, context)
+
+@login_required
+@instrumented('views.thread')
+@mailbox_condition
+def thread(request, message_id, template_name='django_messages/thread.html'):
+    """
+    Shows the whole conversation the message ``message_id`` belongs to,
+    limited to the messages the current user sent or received, oldest first.
+    """
+    message_list = list(Message.objects.thread_for(
+        request.user, message_id).select_related('sender', 'recipient'))
+    if not message_list:
+        raise Http404
+    return render(request, template_name, {
+        'message_list': message_list,
+    })
+
+@login_required
+@instrumented('views.view_broadcast')
+def view_broadcast(request, broadcast_id,
+        template_name='django_messages/view.html'):
+    """
+    Shows a single broadcast addressed to the current user and marks it as
+    read. The template gets the broadcast as ``message``.
+    """
+    broadcast = get_object_or_404(
+        Broadcast.objects.inbox_for(request.user), id=broadcast_id)
+    if broadcast.read_at is None:
+        Broadcast.objects.mark_read(broadcast, request.user)
+    return render(request, template_name, {
+        'message': broadcast,
+        'reply_form': None,
+    })
+
+@login_required
+@instrumented('views.delete_broadcast')
+def delete_broadcast(request, broadcast_id, success_url=None):
+    """
+    Removes a broadcast from the inbox of the current user.
+
+    You can pass ?next=/foo/bar/ via the url to redirect the user to a different
+    page (e.g. `/foo/bar/`) than ``success_url`` after deletion of the message.
+    """
+    broadcast = get_object_or_404(
+        Broadcast.objects.visible_to(request.user), id=broadcast_id)
+    if success_url is None:
+        success_url = reverse('messages_inbox')
+    if 'next' in request.GET:
+        success_url = request.GET['next']
+    Broadcast.objects.mark_deleted(broadcast, request.user)
+    messages.info(request, _(u"Message successfully deleted."))
+    return HttpResponseRedirect(success_url)
+
+@login_required
+@instrumented('views.unread_count')
+@mailbox_condition
+def unread_count(request):
+    """
+    Returns the unread-count of the current user as JSON, e.g. for a badge
+    which is refreshed by polling. Unchanged counts are answered with
+    ``304 Not Modified`` if ``DJANGO_MESSAGES_CACHE`` is set.
+    """
+    return JsonResponse({'count': request_inbox_count(request)})
+
+def _event(name, data, event_id=None):
+    lines = ['event: %s' % name, 'data: %s' % json.dumps(data)]
+    if event_id is not None:
+        lines.insert(0, 'id: %s' % event_id)
+    return '\n'.join(lines) + '\n\n'
+
+def _event_stream(user, last_id, timeout, heartbeat):
+    backend = get_change_backend()
+    if last_id is None or last_id > backend.current():
+        # a new client, or the backend started over since
+        last_id = backend.current()
+    yield 'retry: 1000\n\n'
+    yield _event('unread', {'count': inbox_count_for(user)}, last_id)
+    deadline = time.time() + timeout
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        last_id, events = backend.wait(
+            user.pk, last_id, min(remaining, heartbeat))
+        if not events:
+            yield ': keep-alive\n\n'
+            continue
+        for event in events:
+            if event['type'] == 'message':
+                yield _event('message', event)
+        yield _event('unread', {'count': inbox_count_for(user)}, last_id)
+
+@login_required
+@instrumented('views.stream')
+def stream(request, timeout=None, heartbeat=15):
+    """
+    Streams the unread-count of the current user as Server-Sent Events. An
+    ``unread`` event is sent on connect and whenever the user's mailbox
+    changes, a ``message`` event for every new message. The stream ends
+    after ``timeout`` seconds (default: the ``DJANGO_MESSAGES_STREAM_TIMEOUT``
+    setting or ``30``), ``EventSource`` clients reconnect and continue after
+    the last received event.
+    """
+    if timeout is None:
+        timeout = getattr(settings, 'DJANGO_MESSAGES_STREAM_TIMEOUT', 30)
+    try:
+        last_id = int(request.META['HTTP_LAST_EVENT_ID'])
+    except (KeyError, ValueError):
+        last_id = None
+    response = StreamingHttpResponse(
+        _event_stream(request.user, last_id, timeout, heartbeat),
+        content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # keeps nginx from buffering the events
+    response['X-Accel-Buffering'] = 'no'
+    return response
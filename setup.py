@@ -9,12 +9,14 @@ setup(
     author_email='mail@arnebrodowski.de',
     url='https://github.com/arneb/django-messages',
     install_requires=[
-        'Django'
+        'Django>=2.2,<3.0'
     ],
     packages=(
         'django_messages',
         'django_messages.templatetags',
         'django_messages.migrations',
+        'django_messages.management',
+        'django_messages.management.commands',
     ),
     package_data={
         'django_messages': [
@@ -30,6 +32,7 @@ setup(
         'License :: OSI Approved :: BSD License',
         'Operating System :: OS Independent',
         'Programming Language :: Python',
+        'Programming Language :: Python :: 3',
         'Topic :: Utilities',
         'Framework :: Django',
     ),
@@ -0,0 +1,212 @@
+"""
+Benchmarks of the django-messages hot paths.
+
+Seeds a throwaway test database with users and messages, measures the
+latency and the number of queries of each operation and writes the results
+as JSON. Optionally compares them with a baseline written by an earlier run::
+
+    cd tests
+    python manage.py benchmark --save-baseline benchmarks/baseline.json
+    python manage.py benchmark --baseline benchmarks/baseline.json
+
+Latencies depend on the machine, so record the baseline on the machine the
+comparison runs on. Query counts are compared exactly.
+"""
+import datetime
+import json
+import random
+import time
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.client import Client
+from django.test.utils import (CaptureQueriesContext, setup_test_environment,
+    teardown_test_environment)
+from django.utils import timezone
+
+try:
+    from django.urls import reverse
+except ImportError:
+    from django.core.urlresolvers import reverse
+
+from django_messages.broadcast import run_broadcast
+from django_messages.forms import ComposeForm
+from django_messages.models import BroadcastJob, Message, inbox_count_for
+from django_messages.utils import get_user_model
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks the mailbox queries, views and commands.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=50)
+        parser.add_argument('--messages', type=int, default=5000)
+        parser.add_argument('--fanout', type=int, default=20,
+                            help='Number of recipients of a composed message.')
+        parser.add_argument('--repeat', type=int, default=5,
+                            help='Runs of each operation.')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='Write the results to this file.')
+        parser.add_argument('--baseline',
+                            help='Compare the results with this file.')
+        parser.add_argument('--save-baseline',
+                            help='Write the results as baseline to this file.')
+        parser.add_argument('--tolerance', type=float, default=0.5,
+                            help='Allowed relative slowdown against the '
+                                 'baseline (default: 0.5).')
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0)
+        try:
+            self.seed(options)
+            results = {
+                'dataset': {
+                    'users': options['users'],
+                    'messages': options['messages'],
+                    'fanout': options['fanout'],
+                },
+                'operations': self.run_all(options),
+            }
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        output = json.dumps(results, indent=2, sort_keys=True)
+        for path in (options['output'], options['save_baseline']):
+            if path:
+                with open(path, 'w') as f:
+                    f.write(output + '\n')
+        if not options['output']:
+            self.stdout.write(output)
+        if options['baseline']:
+            self.compare(results, options['baseline'], options['tolerance'])
+
+    def seed(self, options):
+        rnd = random.Random(options['seed'])
+        User.objects.bulk_create([
+            User(username='user%d' % i, email='user%d@example.com' % i)
+            for i in range(options['users'])])
+        user_ids = list(User.objects.values_list('pk', flat=True))
+        now = timezone.now()
+        messages = []
+        for i in range(options['messages']):
+            sent_at = now - datetime.timedelta(minutes=i)
+            deleted_at = sent_at if rnd.random() < 0.1 else None
+            messages.append(Message(
+                sender_id=rnd.choice(user_ids),
+                recipient_id=rnd.choice(user_ids),
+                subject='Subject %d' % i,
+                body='Body of message %d' % i,
+                sent_at=sent_at,
+                read_at=sent_at if rnd.random() < 0.7 else None,
+                recipient_deleted_at=deleted_at,
+                sender_deleted_at=deleted_at if rnd.random() < 0.5 else None,
+            ))
+        Message.objects.bulk_create(messages, batch_size=500)
+        if getattr(settings, 'DJANGO_MESSAGES_COUNTERS', False):
+            call_command('rebuild_mailbox_counters', verbosity=0)
+        self.user = User.objects.get(username='user0')
+        self.user.set_password('secret')
+        self.user.save()
+
+    def measure(self, func, repeat, setup=None):
+        """
+        Calls ``func`` ``repeat`` times and returns the median and minimum
+        latency in milliseconds and the number of queries of the last run.
+        """
+        timings = []
+        for i in range(repeat):
+            if setup is not None:
+                setup()
+            with CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                func()
+                timings.append((time.perf_counter() - start) * 1000)
+        timings.sort()
+        return {
+            'median_ms': round(timings[len(timings) // 2], 3),
+            'min_ms': round(timings[0], 3),
+            'queries': len(queries),
+        }
+
+    def run_all(self, options):
+        repeat = options['repeat']
+        user = self.user
+        page = getattr(settings, 'DJANGO_MESSAGES_PAGE_SIZE', 50)
+        message = (Message.objects.inbox_for(user).first() or
+                   Message.objects.outbox_for(user).first())
+        client = Client()
+        client.force_login(user)
+        recipients = list(User.objects.exclude(pk=user.pk)
+                          [:options['fanout']])
+
+        def view(name, *args):
+            url = reverse(name, args=args)
+            return lambda: client.get(url, {'q': 'message'})
+
+        def compose():
+            form = ComposeForm({
+                'recipient': ','.join(r.username for r in recipients),
+                'subject': 'Benchmark', 'body': 'Body'})
+            form.is_valid()
+            form.save(sender=user)
+
+        def broadcast():
+            run_broadcast(BroadcastJob.objects.create(
+                sender=user, subject='Broadcast', body='Body'))
+
+        def mark_purgeable():
+            long_ago = timezone.now() - datetime.timedelta(days=30)
+            Message.objects.filter(subject='Broadcast').update(
+                sender_deleted_at=long_ago, recipient_deleted_at=long_ago)
+
+        operations = {
+            'inbox_for': lambda: list(Message.objects.inbox_for(user)[:page]),
+            'outbox_for': lambda: list(Message.objects.outbox_for(user)[:page]),
+            'trash_for': lambda: list(Message.objects.trash_for(user)[:page]),
+            'inbox_count_for': lambda: inbox_count_for(user),
+            'view_inbox': view('messages_inbox'),
+            'view_outbox': view('messages_outbox'),
+            'view_trash': view('messages_trash'),
+            'view_detail': view('messages_detail', message.pk),
+            'view_thread': view('messages_thread', message.pk),
+            'view_search': view('messages_search'),
+            'view_unread_count': view('messages_unread_count'),
+            'compose_fanout': compose,
+            'admin_broadcast': broadcast,
+        }
+        results = {}
+        for name in sorted(operations):
+            results[name] = self.measure(operations[name], repeat)
+        results['delete_deleted_messages'] = self.measure(
+            lambda: call_command('delete_deleted_messages', 1, verbosity=0),
+            repeat, setup=lambda: (broadcast(), mark_purgeable()))
+        return results
+
+    def compare(self, results, path, tolerance):
+        with open(path) as f:
+            baseline = json.load(f)
+        if baseline['dataset'] != results['dataset']:
+            raise CommandError('The baseline was recorded with a different '
+                               'dataset: %s' % baseline['dataset'])
+        regressions = []
+        for name, expected in sorted(baseline['operations'].items()):
+            actual = results['operations'].get(name)
+            if actual is None:
+                continue
+            if actual['queries'] > expected['queries']:
+                regressions.append('%s: %d queries instead of %d' % (
+                    name, actual['queries'], expected['queries']))
+            limit = expected['median_ms'] * (1 + tolerance)
+            if actual['median_ms'] > limit:
+                regressions.append('%s: %.1f ms instead of %.1f ms' % (
+                    name, actual['median_ms'], expected['median_ms']))
+        if regressions:
+            raise CommandError('Performance regressions:\n  ' +
+                               '\n  '.join(regressions))
+        self.stderr.write('No regressions against %s.' % path)
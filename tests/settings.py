@@ -1,11 +1,14 @@
 import os.path
 
 INSTALLED_APPS = [
+    'django.contrib.admin',
     'django.contrib.auth',
     'django.contrib.contenttypes',
+    'django.contrib.messages',
     'django.contrib.sessions',
     'django.contrib.sites',
-    'django_messages'
+    'django_messages',
+    'benchmarks',
 ]
 
 # Django >= 2.0